@@ -0,0 +1,480 @@
+""" Defines Summary class, the totals of a database worked out in one pass."""
+
+import heapq
+from array import array
+from datetime import date, timedelta
+from itertools import chain, compress, imap, islice, izip, repeat
+from operator import and_, attrgetter, sub, truediv
+from snidget import table, cube
+
+# Printing the database, its balances, and the totals by type or by recipient
+# used to walk every record once for each of them. A Summary works them all out
+# together, in one pass over the records after the filters are applied, and the
+# Database keeps it until the records, the filters, or the settings it used
+# change.
+#
+# The balance of every account is kept by a Ledger, which remembers how far
+# through the records the running balances are known. Adding a record only
+# costs the work for that record, and changing or removing one only means
+# starting again from shortly before it.
+#
+# When the filters only look at dates, types and locations, totals over days
+# come from the Cube kept by the Database instead of from the records.
+
+# Number of records between the saved totals a Ledger can start again from
+CHECKPOINT = 1024
+
+# Keys records can be grouped by in group_by, and what it can work out for each group
+GROUP_KEYS = ['type', 'dest', 'account', 'week', 'month', 'year', 'id']
+AGGREGATES = ['sum', 'count', 'mean', 'min', 'max']
+
+
+def exchange_rates(database):
+    """ Return the Conversion giving the exchange rate of each slot on any date """
+    return database.context.conversion()
+
+
+def day_amounts(database, visible_only=True):
+    """ Return an iterator over (day as an ordinal, deltas by slot) of the records """
+    records = database.records
+    if isinstance(records, table.RecordTable):
+        records.columns()
+        rows = xrange(len(records))
+        if visible_only:
+            rows = compress(rows, database.visible_mask)
+        deltas = records.deltas
+        dates = records.dates
+        return ((dates[row], [column[row] for column in deltas]) for row in rows)
+    if visible_only:
+        records = compress(records, database.visible_mask)
+    return ((record.date.toordinal(), record.amounts) for record in records)
+
+
+def day_sums(database, accounts, visible_only=True):
+    """ Return a dictionary of day -> array of the total delta of each account, then the value """
+    width = len(accounts)
+    positions = dict((acc, column) for column, acc in enumerate(accounts))
+    days = {}
+    query = database.cube_query(visible_only)
+    if query is not None:
+        totals, mindate, maxdate, match = query
+        rates = cube_rates(database, totals)
+        columns = [positions.get(acc) for acc in totals.accounts]
+        for day, cell in totals.days(mindate, maxdate, match):
+            sums = array('d', [0.0]) * (width + 1)
+            for column, amount in izip(columns, islice(cell, 1, None)):
+                if column is not None:
+                    sums[column] = amount/100.0
+            sums[width] = cube.value(cell, rates.at(day))
+            days[day] = sums
+        return days
+
+    if visible_only:
+        database.apply_filters()
+    rates = exchange_rates(database)
+    columns = [positions.get(acc) for acc in database.context.accounts]
+    for day, amounts in day_amounts(database, visible_only):
+        if day not in days:
+            days[day] = array('d', [0.0]) * (width + 1)
+        sums = days[day]
+        value = 0.0
+        day_rates = rates.at(day)
+        for slot in compress(xrange(len(amounts)), amounts):
+            if columns[slot] is not None:
+                sums[columns[slot]] += amounts[slot]
+            value += amounts[slot]*day_rates[slot]
+        sums[width] += value
+    return days
+
+
+def day_values(database, visible_only=True):
+    """ Return a dictionary of day (as an ordinal) -> total value of the records that day """
+    return dict((day, sums[0]) for day, sums in day_sums(database, [], visible_only).iteritems())
+
+
+def cube_rates(database, totals):
+    """ Return the Conversion giving the exchange rate of each account in a Cube on any date """
+    return database.settings.conversion(totals.accounts)
+
+
+def cube_totals(database, query, field):
+    """ Return a dictionary of the value of the records for each 'type' or 'dest' from a Cube """
+    totals, mindate, maxdate, match = query
+    position = 0 if field == 'type' else 1
+    rates = cube_rates(database, totals)
+    sums = {} # (stretch of exchange rates, type or dest) -> cell of its totals
+    for start, cells in totals.spans(mindate, maxdate, rates.breaks()):
+        stretch = rates.position(start)
+        for key, cell in cells.iteritems():
+            if match is None or match(key):
+                name = (stretch, key[position])
+                if name not in sums:
+                    sums[name] = list(cell)
+                else:
+                    cube.accumulate(sums[name], cell)
+    values = {}
+    for (stretch, name), total in sums.iteritems():
+        values[name] = values.get(name, 0.0) + cube.value(total, rates.vectors[stretch])
+    return values
+
+
+def daily(totals, first, last):
+    """ Return an array of the totals of every day from first to last, as ordinals """
+    return array('d', (totals.get(day, 0.0) for day in xrange(first, last + 1)))
+
+
+def exact_running(values):
+    """ Return the running totals of the values as integers, starting from 0, and their scale """
+    # Every float is an integer over a power of two, so putting them all over the
+    # largest lets them be added up exactly, and much more quickly than fractions.
+    # Dividing a total by the scale gives the float nearest its exact value.
+    ratios = [value.as_integer_ratio() for value in values]
+    places = max([denominator.bit_length() - 1 for numerator, denominator in ratios] + [0])
+    totals = [0]
+    total = 0
+    for numerator, denominator in ratios:
+        total += numerator << (places - denominator.bit_length() + 1)
+        totals.append(total)
+    return totals, 1 << places
+
+
+def moving_sums(values, width):
+    """ Return an array of the sum of each value and the width-1 values before it """
+    # Difference of the running totals at the end and the start of each window
+    cumulative, scale = exact_running(values)
+    sums = imap(sub, islice(cumulative, 1, None), chain(repeat(0, width - 1), cumulative))
+    return array('d', imap(truediv, sums, repeat(scale)))
+
+
+class Ledger(object):
+    """ Ledger class, keeping the running balance of every account up to date """
+    def __init__(self, database):
+        """ Create the ledger of a database, which is worked out when first needed """
+        self.database = database
+        self.valid = 0               # number of records whose running balances are known
+        self.totals = array('d')     # balance of each slot after those records
+        self.checkpoints = []        # totals before every CHECKPOINT'th record
+
+    def changed(self, position=0):
+        """ Note that records were changed from the given position on """
+        if position >= self.valid:
+            return
+        checkpoint = position // CHECKPOINT
+        self.totals = self.checkpoints[checkpoint]
+        self.valid = checkpoint*CHECKPOINT
+        del self.checkpoints[checkpoint:]
+
+    def balances(self):
+        """ Return a dictionary of the balance of every account """
+        records = self.database.records
+        accounts = self.database.context.accounts
+        if isinstance(records, table.RecordTable):
+            # The table keeps its own running balances, a column at a time
+            records.columns()
+            if len(records) == 0:
+                return dict((acc, 0.0) for acc in accounts)
+            return dict((acc, records.running(slot)[-1]) for slot, acc in enumerate(accounts))
+
+        if len(self.totals) < len(accounts):
+            self.totals.extend([0.0] * (len(accounts) - len(self.totals)))
+        totals = self.totals
+        for row, record in enumerate(islice(records, self.valid, None), self.valid):
+            if row % CHECKPOINT == 0:
+                self.checkpoints.append(array('d', totals))
+            amounts = record.amounts
+            balances = record.balances
+            if balances is None or len(balances) < len(amounts):
+                balances = record.balances = array('d', [0.0]) * len(amounts)
+            for slot in compress(xrange(len(amounts)), amounts):
+                totals[slot] += amounts[slot]
+                balances[slot] = totals[slot]
+        self.valid = len(records)
+        return dict(zip(accounts, totals))
+
+
+# Periods a Timeseries can be printed by
+PERIODS = ['day', 'week', 'month']
+
+
+class Timeseries(object):
+    """ Timeseries class, the balance of every account at the end of every day """
+    def __init__(self, database, visible_only=True):
+        """ Work out the balances from the first record to the last """
+        # Columns are in the order the settings list the accounts, as -p and -c show them
+        self.accounts = database.settings.account_keys()
+        self.first = None # first day as an ordinal
+        self.balances = {} # account -> array of its balance at the end of each day
+        self.total = array('d') # total value at the end of each day
+
+        days = day_sums(database, self.accounts, visible_only)
+        if not days:
+            return
+
+        # The running total of each, for every day even if it has no records
+        self.first = min(days)
+        every_day = xrange(self.first, max(days) + 1)
+        for column, acc in enumerate(self.accounts):
+            self.balances[acc] = running(days[day][column] if day in days else 0.0
+                                         for day in every_day)
+        # The total is added up exactly, so rounding errors don't build up over the years
+        totals, scale = exact_running([days[day][-1] if day in days else 0.0
+                                       for day in every_day])
+        self.total = array('d', imap(truediv, islice(totals, 1, None), repeat(scale)))
+
+    def __len__(self):
+        return len(self.total)
+
+    def rows(self, period='day'):
+        """ Return an iterator over (date, balances, total) at the end of each period """
+        for index in xrange(len(self.total)):
+            when = date.fromordinal(self.first + index)
+            if index < len(self.total) - 1:
+                following = when + timedelta(1)
+                if period == 'week' and following.weekday() != 0:
+                    continue
+                if period == 'month' and following.month == when.month:
+                    continue
+            yield (when, [self.balances[acc][index] for acc in self.accounts], self.total[index])
+
+
+def running(values):
+    """ Return an array of the running total of the values """
+    totals = array('d')
+    total = 0.0
+    for value in values:
+        total += value
+        totals.append(total)
+    return totals
+
+
+def account_totals(settings, sums=None):
+    """ Return a dictionary of the totals of every account which isn't deleted, zero if not in sums """
+    deleted = set(settings.deleted_account_keys())
+    totals = {}
+    for acc in settings.accounts().iterkeys():
+        if acc not in deleted:
+            totals[acc] = 0.0
+    if sums is not None:
+        for acc, value in sums.iteritems():
+            if acc in totals:
+                totals[acc] = value
+    return totals
+
+
+def add_sum(settings, totals):
+    """ Add the total of a dictionary of account balances at today's rates, as 'sum' """
+    foreign = set(settings.foreign_account_keys())
+    totals['sum'] = 0.0
+    for acc, value in totals.items():
+        # protect against the fact that 'sum' will be one of the accounts...
+        if acc != 'sum':
+            if acc in foreign:
+                totals['sum'] += value*settings.exchange(acc)
+            else:
+                totals['sum'] += value
+    return totals
+
+
+def cube_deltas(database, query, mindate=None):
+    """ Return the total delta of each account from a Cube, from mindate if later, and their value """
+    # The value is at the exchange rates on the date of each record, like the records' own values
+    totals, low, high, match = query
+    if mindate is not None and (low is None or mindate > low):
+        low = mindate
+    # Deleted accounts are left out of the value, as they are out of the totals
+    rates = cube_rates(database, totals).without(totals.accounts,
+                                                 set(database.settings.deleted_account_keys()))
+    stretches = {} # stretch of exchange rates -> cell of its totals
+    if low is None or high is None or low < high:
+        for start, cells in totals.spans(low, high, rates.breaks()):
+            stretch = rates.position(start)
+            if stretch not in stretches:
+                stretches[stretch] = [0]
+            for key, cell in cells.iteritems():
+                if match is None or match(key):
+                    cube.accumulate(stretches[stretch], cell)
+    sums = [0] * (len(totals.accounts) + 1)
+    value = 0.0
+    for stretch, cell in stretches.iteritems():
+        cube.accumulate(sums, cell)
+        value += cube.value(cell, rates.vectors[stretch])
+    return (dict((acc, sums[column]/100.0) for column, acc in enumerate(totals.accounts, 1)),
+            value)
+
+
+def cube_balances(database, query):
+    """ Return the balances of Summary from a Cube and the ledger, without visiting the records """
+    settings = database.settings
+    week_start = settings.TODAY - settings.ONEWEEK + timedelta(1)
+    visible, visible_value = cube_deltas(database, query)
+    weekly, weekly_value = cube_deltas(database, query, week_start)
+    balances = {
+        'all': add_sum(settings, account_totals(settings, database.ledger.balances())),
+        'visible': account_totals(settings, visible),
+        'thisweek': account_totals(settings, weekly),
+    }
+    balances['visible']['sum'] = visible_value
+    balances['thisweek']['sum'] = weekly_value
+    return balances
+
+
+class Summary(object):
+    """ Summary class, holding the balances and totals of the visible records """
+    def __init__(self, database):
+        """ Work out every total of the database, as currently filtered """
+        settings = database.settings
+        deleted = set(settings.deleted_account_keys())
+
+        balance = account_totals(settings)
+        wbalance = account_totals(settings) # Running balance over last week
+        vbalance = account_totals(settings) # Balance of visible records
+
+        self.by_type = {}      # type -> value of visible records
+        self.by_recipient = {} # recipient -> value of visible records
+
+        for acc, value in database.ledger.balances().iteritems():
+            if acc in balance:
+                balance[acc] = value
+        if isinstance(database.records, table.RecordTable):
+            values = self.sum_table(database, vbalance, wbalance, deleted)
+        else:
+            values = self.sum_list(database, vbalance, wbalance, deleted)
+
+        # Now add another field for the sum in the default currency. Balances are
+        # worth what they are at today's rates, while the visible records add up to
+        # their values at the rates on their dates, like the VALUE column. Either way,
+        # deleted accounts are left out.
+        add_sum(settings, balance)
+        vbalance['sum'], wbalance['sum'] = values
+
+        self.balances = {
+            'all':balance,
+            'visible':vbalance,
+            'thisweek':wbalance
+        }
+
+    def add_visible(self, record_type, dest, value):
+        """ Count a visible record towards the totals by type and recipient """
+        if record_type not in self.by_type:
+            self.by_type[record_type] = value
+        else:
+            self.by_type[record_type] += value
+        if dest not in self.by_recipient:
+            self.by_recipient[dest] = value
+        else:
+            self.by_recipient[dest] += value
+
+    def sum_list(self, database, vbalance, wbalance, deleted):
+        """ Work out the totals of the visible records in a list, returning their value and this week's """
+        accounts = database.context.accounts
+        conversion = database.context.conversion().without(accounts, deleted)
+        week_start = database.settings.TODAY - database.settings.ONEWEEK
+        visible_value = 0.0
+        weekly_value = 0.0
+        for record in compress(database.records, database.visible_mask):
+            recent = record.date > week_start
+            rates = conversion.at(record.date.toordinal())
+            value = 0.0
+            for slot, delta in enumerate(record.amounts):
+                if delta != 0.0:
+                    acc = accounts[slot]
+                    if acc not in deleted:
+                        if recent:
+                            wbalance[acc] += delta
+                        vbalance[acc] += delta
+                        value += delta*rates[slot]
+            visible_value += value
+            if recent:
+                weekly_value += value
+            self.add_visible(record.type, record.dest, record.value())
+        return (visible_value, weekly_value)
+
+    def sum_table(self, database, vbalance, wbalance, deleted):
+        """ Work out the totals of the visible rows of a RecordTable, returning their value and this week's """
+        records = database.records
+        recent = database.select_dates(database.settings.TODAY - database.settings.ONEWEEK
+                                       + timedelta(1))
+        recent = bytearray(imap(and_, recent, records.visibles))
+        for totals, selectors in [(vbalance, records.visibles),
+                                  (wbalance, recent)]:
+            for acc, value in records.sums(selectors).iteritems():
+                if acc in totals:
+                    totals[acc] += value
+
+        values = records.values()
+        strings = records.strings
+        for row in compress(xrange(len(records)), records.visibles):
+            self.add_visible(strings[records.types[row]], strings[records.dests[row]], values[row])
+        if deleted:
+            values = records.values(database.context.conversion().without(
+                database.context.accounts, deleted))
+        return (sum(compress(values, records.visibles)), sum(compress(values, recent)))
+
+
+def largest(totals, limit=None):
+    """ Return the (key, value) pairs of a dictionary largest value first, at most limit of them """
+    # Picking the largest few with a heap takes O(n log limit) rather than
+    # sorting everything, which matters with thousands of locations
+    items = ((value, key) for key, value in totals.iteritems())
+    if limit is None:
+        ranked = sorted(items, reverse=True)
+    else:
+        ranked = heapq.nlargest(limit, items)
+    return [(key, value) for value, key in ranked]
+
+
+def group_key(name):
+    """ Return a function giving the group of a record for any key but 'account' """
+    if name == 'week':
+        return lambda record: "%04d-W%02d" % record.date.isocalendar()[:2]
+    if name == 'month':
+        return lambda record: "%04d-%02d" % (record.date.year, record.date.month)
+    if name == 'year':
+        return lambda record: "%04d" % record.date.year
+    return attrgetter(name)
+
+
+def group_by(database, keys, aggregates=('sum',)):
+    """ Return a dictionary of group -> aggregates of the value of the visible records """
+    # A group is a tuple with a string for each key. Grouping by account counts
+    # the value of each delta towards its account, rather than the whole record.
+    database.apply_filters()
+    conversion = exchange_rates(database)
+    names = [database.settings.account_name(acc) for acc in database.context.accounts]
+    getters = [group_key(key) if key != 'account' else None for key in keys]
+    by_account = 'account' in keys
+
+    stats = {} # group -> [count, sum, min, max]
+    def include(group, value):
+        """ Count a value towards the statistics of a group """
+        if group not in stats:
+            stats[group] = [1, value, value, value]
+        else:
+            found = stats[group]
+            found[0] += 1
+            found[1] += value
+            if value < found[2]:
+                found[2] = value
+            if value > found[3]:
+                found[3] = value
+
+    for record in compress(database.records, database.visible_mask):
+        amounts = record.amounts
+        rates = conversion.at(record.date.toordinal())
+        fields = [getter(record) if getter is not None else None for getter in getters]
+        if by_account:
+            for slot in compress(xrange(len(amounts)), amounts):
+                include(tuple(names[slot] if getter is None else field
+                              for getter, field in izip(getters, fields)),
+                        amounts[slot]*rates[slot])
+        else:
+            value = 0.0
+            for slot in compress(xrange(len(amounts)), amounts):
+                value += amounts[slot]*rates[slot]
+            include(tuple(fields), value)
+
+    results = {}
+    for group, (count, total, lowest, highest) in stats.iteritems():
+        found = {'sum': total, 'count': count, 'mean': total/count, 'min': lowest, 'max': highest}
+        results[group] = tuple(found[name] for name in aggregates)
+    return results
@@ -16,7 +16,7 @@ from __future__ import print_function
 import sys # to get command line options
 import getopt # to parse command line options
 
-from snidget import settings, database, transaction, latex
+from snidget import settings, database, transaction, latex, filters, aggregate, export
 
 # Load the user settings and database
 settings = settings.Settings()
@@ -33,11 +33,72 @@ def usage():
     return output
 
 
-# Unused option letters: jklmyz GHIJKMOPQYZ
+def print_balances(balances):
+    """ Print a dictionary of account balances, and their total """
+    total = 0.0
+    for acc in settings.accounts().iterkeys():
+        if acc not in settings.deleted_account_keys():
+            if acc in settings.foreign_account_keys():
+                print("%-15s %12.2f = %12.2f" %
+                      (settings.account_name(acc), balances[acc],
+                       balances[acc]*settings.exchange(acc)))
+                total += balances[acc]*settings.exchange(acc)
+            else:
+                print("%-15s %12.2s   %12.2f" %
+                      (settings.account_name(acc), "", balances[acc]))
+                total += balances[acc]
+    print("%-15s %12.2s   ============" % ("", ""))
+    print("%-15s %12.2s   %12.2f" % ("Total", "", total))
+
+
+def print_series(rows):
+    """ Print the balance of every account and the total on each line """
+    for when, balances, total in rows:
+        output = "%s " % when
+        for balance in balances:
+            output += "%9.2f " % balance
+        output += "%9.2f " % total
+        print(output)
+
+
+def print_ranking(totals, limit):
+    """ Print the largest totals in order, then any others together and the overall total """
+    ranked = aggregate.largest(totals, limit)
+    total = 0.0
+    for name, value in ranked:
+        total += value
+        print("  %-35s %9.2f" % (name, value))
+    if len(ranked) < len(totals):
+        others = sum(totals.itervalues()) - total
+        total += others
+        print("  %-35s %9.2f" % ("(%d others)" % (len(totals) - len(ranked)), others))
+    print("  =============================================")
+    print("  %35s %9.2f" % (" ", total))
+
+
+def print_groups(keys, aggregates, groups):
+    """ Print the aggregates of each group, one group to a line in order """
+    widths = [max([len(key)] + [len(group[column]) for group in groups])
+              for column, key in enumerate(keys)]
+    output = "  ".join("%-*s" % (width, key.upper()) for width, key in zip(widths, keys))
+    for name in aggregates:
+        output += " %10s" % name.upper()
+    print(output)
+    for group in sorted(groups):
+        output = "  ".join("%-*s" % (width, field) for width, field in zip(widths, group))
+        for name, result in zip(aggregates, groups[group]):
+            if name == 'count':
+                output += " %10d" % result
+            else:
+                output += " %10.2f" % result
+        print(output)
+
+
+# Unused option letters: lz GHIJKMOPQYZ
 def parse_args(argv):
     """ Process command line arguments. """
     try:
-        opts, args = getopt.getopt(argv, "acbd:e:f:ghino:pqrstuvwx:A:B:C:D:EF:L:N:RS:T:UV:WX:", [])
+        opts, args = getopt.getopt(argv, "acbd:e:f:ghij:k:m:no:pqrstuvwx:y:A:B:C:D:EF:L:N:RS:T:UV:WX:", [])
     except getopt.GetoptError:
         print("Unrecognized option or bad argument. Use -h to get usage information.")
         sys.exit(2)
@@ -46,53 +107,43 @@ def parse_args(argv):
 
         if opt == "-a":
             # Print all visible records, no matter how many there are
-            print(database.__str__(len(database.records)))
+            database.write(sys.stdout, print_all=True)
+            print()
 
         elif opt == "-c":
             # Print current balances of all accounts
-            balances = database.balances()['all']
-            total = 0.0
-            for acc in settings.accounts().iterkeys():
-                if acc not in settings.deleted_account_keys():
-                    if acc in settings.foreign_account_keys():
-                        print("%-15s %12.2f = %12.2f" %
-                              (settings.account_name(acc), balances[acc],
-                               balances[acc]*settings.exchange(acc)))
-                        total += balances[acc]*settings.exchange(acc)
-                    else:
-                        print("%-15s %12.2s   %12.2f" %
-                              (settings.account_name(acc), "", balances[acc]))
-                        total += balances[acc]
-            print("%-15s %12.2s   ============" % ("", ""))
-            print("%-15s %12.2s   %12.2f" % ("Total", "", total))
+            print_balances(database.balances()['all'])
 
         elif opt == "-b":
-            for datapoint in database.integrate_deltas():
-                output = ""
-                output += "%s " % datapoint[0]
-                # +1 because we have a column for the total
-                for i in range(0, len(settings.accounts()) + 1):
-                    output += "%9.2f " % datapoint[1+i]
-                print(output)
+            print_series(database.balance_series().rows())
+
+        elif opt == "-m":
+            # Balances at the end of each week or month, argument required
+            if arg not in aggregate.PERIODS:
+                print("Invalid option: -m " + arg)
+                continue
+            print_series(database.balance_series().rows(arg))
 
         elif opt == "-d":
             # Integrate over some number of days, argument required.
-            # -d 7 is the same as -w
-            #! Should this be a function in the database class?
-            total = 0.0
-            num = 0
+            # -d 7 is the same as -w, and -d 7,30 prints a column for each
             try:
-                num_days = int(arg)
+                windows = [int(num_days) for num_days in str.split(arg, ',')]
             except ValueError:
                 print("Invalid option: -d " + arg)
                 continue
-            for datapoint in database.integrate(num_days):
-                # datapoint is a (date, float) tuple
-                print("%s %.2f" % datapoint)
-                total += float(datapoint[1])
+            if min(windows) < 1:
+                print("Invalid option: -d " + arg)
+                continue
+            totals = [0.0] * len(windows)
+            num = 0
+            for datapoint in database.integrate_windows(windows):
+                # datapoint is a (date, list of floats) tuple
+                print("%s %s" % (datapoint[0], " ".join("%.2f" % value for value in datapoint[1])))
+                totals = [total + value for total, value in zip(totals, datapoint[1])]
                 num += 1
-            ave = total/num if num > 0 else 0
-            print("# Average: %.2f" % ave)
+            aves = [total/num if num > 0 else 0 for total in totals]
+            print("# Average: %s" % " ".join("%.2f" % ave for ave in aves))
 
         elif opt == "-e":
             # Edit an entry identified by uid=arg
@@ -117,12 +168,48 @@ def parse_args(argv):
             if arg == "latex":
                 # Print a latex report
                 latex.output(database, settings)
-            elif arg == "csv":
-                # Print in CSV
-                print(database.__str__(csv=True))
+            elif arg.partition(':')[0] == "csv":
+                # Write every visible record as CSV, optionally picking fields, e.g. csv:date,value,balances
+                names = arg.partition(':')[2]
+                fields = str.split(names, ',') if names else None
+                if fields is not None and not all(field in export.CSV_FIELDS for field in fields):
+                    print("Invalid option: -f " + arg)
+                    continue
+                export.write_csv(database, sys.stdout, fields)
+            elif arg == "jsonl":
+                # Write every visible record as a line of JSON
+                export.write_jsonl(database, sys.stdout)
             else:
                 print("Format '%s' not supported" % (arg))
 
+        elif opt == "-j":
+            # Add the records in a file of JSON lines, or standard input for -
+            try:
+                stream = sys.stdin if arg == "-" else open(arg, 'r')
+            except IOError:
+                print("Cannot open %s" % arg)
+                continue
+            if export.read_jsonl(database, stream) > 0:
+                database.save()
+            if stream is not sys.stdin:
+                stream.close()
+
+        elif opt == "-k":
+            # Print balances at the end of a date, or their change between two dates
+            try:
+                dates = [filters.parse_date(when) for when in str.split(arg, ',')]
+            except (ValueError, IndexError):
+                print("Invalid option: -k " + arg)
+                continue
+            if len(dates) > 1 and dates[1] < dates[0]:
+                # A range that ends before it starts would show every account unchanged
+                print("Invalid option: -k " + arg)
+                continue
+            if len(dates) == 1:
+                print_balances(database.balances_on(dates[0]))
+            else:
+                print_balances(database.balances_between(dates[0], dates[1]))
+
         elif opt == "-n":
             # Create a new entry in the database
             database.new_record()
@@ -134,20 +221,17 @@ def parse_args(argv):
 
         elif opt == "-p":
             # Print the database as it currently stands
-            print(database)
+            database.write(sys.stdout)
+            print()
 
         elif opt == "-q":
             # Include a running tally of each account
-            print(database.__str__(print_running_balances=True))
+            database.write(sys.stdout, print_running_balances=True)
+            print()
 
         elif opt == "-r":
-            # Print recipients
-            destsum = 0.0
-            for dest in database.balances_by_recipient():
-                destsum += float(dest[1])
-                print("  %-35s %9.2f" % (dest[0], float(dest[1])))
-            print("  =============================================")
-            print("  %35s %9.2f" % (" ", destsum))
+            # Print recipients, as many as maxprint
+            print_ranking(database.totals_by('dest'), database.maxprint())
 
         elif opt == "-s":
             # Sort records by date
@@ -155,13 +239,8 @@ def parse_args(argv):
             database.save()
 
         elif opt == "-t":
-            # Print types
-            typesum = 0.0
-            for expense_type in database.balances_by_type():
-                typesum += float(expense_type[1])
-                print("  %-35s %9.2f" % (expense_type[0], float(expense_type[1])))
-            print("  =============================================")
-            print("  %35s %9.2f" % (" ", typesum))
+            # Print types, as many as maxprint
+            print_ranking(database.totals_by('type'), database.maxprint())
 
         elif opt == "-u":
             print("Updating all exchange rates (but you must save explicitly with -o save!)")
@@ -169,11 +248,11 @@ def parse_args(argv):
 
         elif opt == "-v":
             # Like -p but print values, not individual accounts
-            print(database.__str__(total_value=not settings.total_values()))
+            database.write(sys.stdout, total_value=not settings.total_values())
+            print()
 
         elif opt == "-w":
             # Integrate over n days, defaults to 7.
-            #! Should this be a function in the database class?
             total = 0.0
             num = 0
             for datapoint in database.integrate():
@@ -184,11 +263,21 @@ def parse_args(argv):
             ave = total/num if num > 0 else 0
             print("# Average: %.2f" % ave)
 
+        elif opt == "-y":
+            # Print totals grouped by some keys, e.g. -y month,type:sum,count
+            keys, _, names = arg.partition(':')
+            keys = str.split(keys, ',')
+            aggregates = str.split(names, ',') if names else ['sum']
+            if (not all(key in aggregate.GROUP_KEYS for key in keys)
+                    or not all(name in aggregate.AGGREGATES for name in aggregates)):
+                print("Invalid option: -y " + arg)
+                continue
+            print_groups(keys, aggregates, database.group_by(keys, aggregates))
+
         elif opt == "-x":
-            # Delete a record by uid
+            # Delete records by uid, all at once
             uids = str.split(arg.rstrip(), ",")
-            for uid in uids:
-                database.delete(uid)
+            database.delete_many(uids)
             database.save()
 
         elif opt == "-A":
@@ -0,0 +1,284 @@
+""" Totals of the records by day, month and year, kept beside the database file."""
+
+import marshal
+from bisect import bisect_right
+from datetime import date, timedelta
+from itertools import compress, izip
+from operator import add
+from snidget import snapshot, table
+
+# Most reports only want totals by type, location or account over some range
+# of dates. The Cube keeps, for every day, month and year, the number of
+# records and the total delta in each account for every (type, location) pair,
+# as well as the totals of each day over all pairs. Any range of dates is then
+# covered by a few whole years and months and the odd days at either end,
+# without looking at individual records. Deltas are kept in whole cents, so
+# adding and taking away records is always exact.
+#
+# Like the snapshot, the cube is written beside the database file when the file
+# is rewritten, and only read back while the file is unchanged. Changes
+# replayed from the journal are applied to it after it is read. The totals of
+# each period are stored separately, and only unpacked when first used.
+
+# Change this whenever the layout of the stored cube changes
+FORMAT = 2
+
+# Levels of the cube, from the finest to the coarsest
+LEVELS = ['day', 'month', 'year']
+
+
+def cents(delta):
+    """ Return a delta as a whole number of cents """
+    return int(round(delta*100))
+
+
+def periods(day):
+    """ Return the period at each level containing a day, given as an ordinal """
+    when = date.fromordinal(day)
+    return (day, when.year*12 + when.month - 1, when.year)
+
+
+def entry(record, accounts):
+    """ Return (day, (type, dest), [(account, cents), ...]) of a record, accounts by slot """
+    amounts = record.amounts
+    return (record.date.toordinal(), (record.type, record.dest),
+            [(accounts[slot], cents(amounts[slot]))
+             for slot in compress(xrange(len(amounts)), amounts)])
+
+
+def entries(records, accounts):
+    """ Return an iterator over the entries of a list of records """
+    if not isinstance(records, table.RecordTable):
+        return (entry(record, accounts) for record in records)
+    records.columns()
+    strings = records.strings
+    columns = zip(accounts, records.deltas)
+    return ((records.dates[row], (strings[records.types[row]], strings[records.dests[row]]),
+             [(acc, cents(column[row])) for acc, column in columns if column[row] != 0.0])
+            for row in xrange(len(records)))
+
+
+def following(when, level):
+    """ Return the first day after the period of the given level starting on when """
+    if level == 'year':
+        return date(when.year + 1, 1, 1)
+    if level == 'month':
+        if when.month == 12:
+            return date(when.year + 1, 1, 1)
+        return date(when.year, when.month + 1, 1)
+    return when + timedelta(1)
+
+
+def accumulate(total, cell):
+    """ Add the count and cents of a cell to another """
+    if len(total) < len(cell):
+        total.extend([0] * (len(cell) - len(total)))
+    total[:len(cell)] = map(add, total[:len(cell)], cell)
+
+
+def update(cells, key, change):
+    """ Add a change to the cell with the given key, removing the cell once it has no records """
+    if key not in cells:
+        cells[key] = [0] * len(change)
+    cell = cells[key]
+    accumulate(cell, change)
+    if cell[0] == 0:
+        # No records left, so every total is zero too
+        del cells[key]
+
+
+def value(cell, rates):
+    """ Return the total value of a cell, given the exchange rate of each account """
+    total = 0.0
+    for amount, rate in izip(cell[1:], rates):
+        if amount != 0:
+            total += amount*rate
+    return total/100.0
+
+
+class Cube(object):
+    """ Cube class, the totals of the records for every day, month and year """
+    def __init__(self, filename, source):
+        """ Create a cube stored in filename, matching the file source """
+        self.filename = filename
+        self.source = source
+        self.ready = False # whether the totals are known
+        self.accounts = [] # account of each column of a cell, after the count
+        self.columns = {}  # account -> column in a cell
+        self.levels = dict((level, {}) for level in LEVELS) # level -> period -> (type, dest) -> cell
+        self.daily = {}    # day -> cell of the totals over all pairs
+
+    def reset(self):
+        """ Forget the totals, which will be worked out again when next needed """
+        self.ready = False
+        self.accounts = []
+        self.columns = {}
+        self.levels = dict((level, {}) for level in LEVELS)
+        self.daily = {}
+
+    def build(self, records, accounts):
+        """ Work out the totals of a list of records, with accounts by slot """
+        self.reset()
+        days = self.levels['day']
+        for day, key, amounts in entries(records, accounts):
+            if day not in days:
+                days[day] = {}
+            if key not in days[day]:
+                days[day][key] = [0]
+            cell = days[day][key]
+            cell[0] += 1
+            for acc, amount in amounts:
+                column = self.column(acc)
+                if column >= len(cell):
+                    cell.extend([0] * (column + 1 - len(cell)))
+                cell[column] += amount
+
+        # Then roll the days up into months, years, and the totals of each day
+        for day, cells in days.iteritems():
+            month, year = periods(day)[1:]
+            for level, period in [('month', month), ('year', year)]:
+                if period not in self.levels[level]:
+                    self.levels[level][period] = {}
+                rollup = self.levels[level][period]
+                for key, cell in cells.iteritems():
+                    if key in rollup:
+                        accumulate(rollup[key], cell)
+                    else:
+                        rollup[key] = list(cell)
+            total = self.daily[day] = [0]
+            for cell in cells.itervalues():
+                accumulate(total, cell)
+        self.ready = True
+
+    def column(self, acc):
+        """ Return the column of an account, adding it if needed """
+        if acc not in self.columns:
+            self.accounts.append(acc)
+            self.columns[acc] = len(self.accounts)
+        return self.columns[acc]
+
+    def cells(self, level, period):
+        """ Return the dictionary of (type, dest) -> cell of a period, or None if it is empty """
+        cells = self.levels[level].get(period)
+        if isinstance(cells, str):
+            cells = self.levels[level][period] = marshal.loads(cells)
+        return cells
+
+    def apply(self, item, sign=1):
+        """ Add an entry to the totals, or take it away again if sign is -1 """
+        day, key, amounts = item
+        change = [sign]
+        for acc, amount in amounts:
+            column = self.column(acc)
+            if column >= len(change):
+                change.extend([0] * (column + 1 - len(change)))
+            change[column] += sign*amount
+        for level, period in izip(LEVELS, periods(day)):
+            cells = self.cells(level, period)
+            if cells is None:
+                cells = self.levels[level][period] = {}
+            update(cells, key, change)
+            if not cells:
+                del self.levels[level][period]
+        update(self.daily, day, change)
+
+    def spans(self, mindate=None, maxdate=None, breaks=()):
+        """ Return an iterator over (first day, cells) of periods covering mindate up to but not maxdate """
+        # No period spans any of the days in breaks, given as ordinals, unless it starts there
+        years = self.levels['year']
+        if not years:
+            return
+        first = date(min(years), 1, 1)
+        last = date(max(years) + 1, 1, 1)
+        when = first if mindate is None else max(mindate, first)
+        end = last if maxdate is None else min(maxdate, last)
+        while when < end:
+            # Take the longest period which starts here and ends in time
+            day = when.toordinal()
+            spot = bisect_right(breaks, day)
+            limit = breaks[spot] if spot < len(breaks) else None
+            for level in reversed(LEVELS):
+                after = following(when, level)
+                if level == 'day' or (after <= end and when.day == 1
+                                      and (level == 'month' or when.month == 1)
+                                      and (limit is None or after.toordinal() <= limit)):
+                    break
+            cells = self.cells(level, periods(day)[LEVELS.index(level)])
+            if cells:
+                yield (day, cells)
+            when = after
+
+    def days(self, mindate=None, maxdate=None, match=None):
+        """ Return an iterator over (day as an ordinal, cell) from mindate up to but not maxdate """
+        # Only pairs passing the test match are counted, and days without any are left out
+        low = None if mindate is None else mindate.toordinal()
+        high = None if maxdate is None else maxdate.toordinal()
+        for day, day_cell in self.daily.iteritems():
+            if (low is not None and day < low) or (high is not None and day >= high):
+                continue
+            if match is None:
+                yield (day, day_cell)
+                continue
+            total = None
+            for key, cell in self.cells('day', day).iteritems():
+                if match(key):
+                    if total is None:
+                        total = list(cell)
+                    else:
+                        accumulate(total, cell)
+            if total is not None:
+                yield (day, total)
+
+    def load(self, accounts):
+        """ Read the stored totals, returning False if they are out of date """
+        try:
+            cube_file = open(self.filename, 'rb')
+            stored = marshal.load(cube_file)
+            cube_file.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+
+        if (not isinstance(stored, dict)
+                or stored.get('format') != FORMAT
+                or stored.get('signature') != snapshot.signature(self.source)):
+            return False
+
+        # Records have no deltas in accounts the settings didn't have when the totals
+        # were worked out, so work them out again from the records if the accounts changed
+        if stored.get('known') != sorted(accounts):
+            return False
+
+        self.accounts = list(stored['accounts'])
+        self.columns = dict((acc, column) for column, acc in enumerate(self.accounts, 1))
+        self.levels = stored['levels']
+        self.daily = stored['daily']
+        self.ready = True
+        return True
+
+    def save(self, accounts):
+        """ Write the totals, which must match the source file, given the settings accounts """
+        if not self.ready:
+            return
+        levels = {}
+        for level, periods_cells in self.levels.iteritems():
+            levels[level] = {}
+            for period, cells in periods_cells.iteritems():
+                # Periods never unpacked are still in their stored form
+                if not isinstance(cells, str):
+                    cells = marshal.dumps(cells)
+                levels[level][period] = cells
+        stored = {
+            'format': FORMAT,
+            'signature': snapshot.signature(self.source),
+            'accounts': self.accounts,
+            'known': sorted(accounts),
+            'levels': levels,
+            'daily': self.daily,
+        }
+        try:
+            cube_file = open(self.filename, 'wb')
+            marshal.dump(stored, cube_file)
+            cube_file.close()
+        except IOError:
+            # The cube is only a cache, so failing to write it is not fatal
+            pass
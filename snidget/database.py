@@ -2,22 +2,21 @@
 
 from __future__ import print_function
 import sys
+from bisect import bisect_right
+from cStringIO import StringIO
 from datetime import timedelta, date
-from snidget import transaction
+from itertools import compress, imap, islice, izip
+from operator import le
+from snidget import transaction, journal, snapshot, table, filters, index, aggregate, cube, render
 
 # Defines Database class, the main workhorse in the Snidget program
 # It is basically a container object for all the transactions on record,
 # including the functions for determining which records to show when printed
 
-def sort_balances(balances):
-    """ Helper func to sort dictionaries of balances by value """
-    items = [(value, key) for key, value in balances.items()]
-    items.sort()
-    items.reverse() # so largest is first
-    # Our dictionary has become a list of tuples to maintain order
-    #return [(k, v) for v, k in items]
-    # The GUI requires the value be a string.
-    return [(key, "%.2f" % value) for value, key in items]
+def sort_balances(balances, limit=None):
+    """ Helper func to sort dictionaries of balances by value, keeping only the largest limit """
+    # Our dictionary becomes a list of tuples to maintain order, largest first
+    return aggregate.largest(balances, limit)
 
 
 class Database(object):
@@ -39,38 +38,94 @@ class Database(object):
             record_file.close()
             record_file = open(self.filename, 'r')
 
-        self.records = []
-        # Read in all the records of the file
-        for line in record_file:#.readlines():
-            self.add(transaction.Transaction(self, settings, line))
+        # Everything the records have in common is kept once, here
+        self.context = transaction.Context(self, settings)
+
+        # A snapshot of the parsed file lets us skip parsing it if it has not changed
+        self.snapshot = snapshot.Snapshot("%s.cache" % self.filename, self.filename)
+        columns = self.snapshot.load(settings.accounts())
+        if settings.engine() == "table":
+            # Records are kept column by column, and handed out as views of a row
+            self.records = table.RecordTable(self, settings)
+        else:
+            self.records = []
+        if columns is not None:
+            if isinstance(self.records, table.RecordTable):
+                self.records.load(columns)
+            else:
+                self.records = snapshot.transactions(columns, self.context)
+        else:
+            # Read in all the records of the file
+            for line in record_file:#.readlines():
+                self.records.append(transaction.Transaction(self, settings, line))
+            self.snapshot.save(self.records, settings.accounts())
         record_file.close()
+
+        # Whether the records are in order of their sort keys, or None if not known yet
+        self.ordered = None
+
+        # Totals by day, month and year, read from beside the database file when first needed
+        self.cube = cube.Cube("%s.cube" % self.filename, self.filename)
+        # Changes since the file was read, as (cube entry, 1 or -1), or None if not known
+        self.cube_changes = []
+
+        # Bring the records up to date with changes journaled since the last full save
+        self.journal = journal.Journal("%s.journal" % self.filename)
+        for action, argument in self.journal.entries():
+            self.replay(action, argument)
+
         self.is_changed = False
+        # Set when the journal cannot describe the changes, e.g. after sorting
+        self.needs_rewrite = False
+
+        # Counts changes to the records, so anything worked out from them knows when to redo it
+        self.version = 0
+        # Visibility of every record for recently applied filters, see apply_filters
+        self.visibility = {}
+        self.visibility_order = []
+        self.visible_key = None
+        self.visible_mask = None
+        # Indexes of the records, so filters can skip records they cannot match
+        self.indexes = index.Indexes(self)
+        # Balances of the accounts, kept up to date as records change
+        self.ledger = aggregate.Ledger(self)
+        # Totals of the records, see summary
+        self.summary_cache = None
+        self.summary_key = None
         self.filters = settings.filters()
 
-    def __str__(self, total_value=None, print_running_balances=False, csv=False):
+    def __str__(self, total_value=None, print_running_balances=False):
         """ Print the database as a table to the screen """
+        output = StringIO()
+        self.write(output, total_value, print_running_balances)
+        return output.getvalue()
 
-        if "maxprint" in self.filters:
-            maxprint = self.filters['maxprint']
-        else:
-            maxprint = self.settings.maxprint()
+    def write(self, stream, total_value=None, print_running_balances=False, print_all=False):
+        """ Write the database as a table to a stream, a line at a time """
+
+        maxprint = None if print_all else self.maxprint()
 
         if total_value is None:
             total_value = self.settings.total_values()
 
         self.apply_filters()
-        balances = self.balances()
-
-        # Make a list of visible records
-        # so we can make use of MAXPRINT in array indices
-        all_printable = []
-        for record in self.records:
-            if record.visible:
-                all_printable.append(record)
-        if maxprint is not None:
-            printable = all_printable[-maxprint:]
+        balances = self.footer_balances()
+
+        # Only the last maxprint visible records are printed, so look back from
+        # the end until there are enough. Without a limit, go over the visible
+        # records twice rather than keeping a list of them.
+        if maxprint:
+            positions = []
+            end = len(self.visible_mask)
+            while len(positions) < maxprint:
+                end = self.visible_mask.rfind('\x01', 0, end)
+                if end < 0:
+                    break
+                positions.append(end)
+            printable = [self.records[position] for position in reversed(positions)]
+            records = lambda: printable
         else:
-            printable = all_printable
+            records = lambda: compress(self.records, self.visible_mask)
 
         # Determine appropriate column widths
         print_id = False # Don't print the ID column unless there is data there
@@ -78,7 +133,7 @@ class Database(object):
         w_dest = 8
         w_desc = 11
         w_date = 10
-        for record in printable:
+        for record in records():
             if len(record.type) > w_type:
                 w_type = len(record.type)
             if len(record.dest) > w_dest:
@@ -90,101 +145,79 @@ class Database(object):
 
         # Write out the header stuff for the table
         # Make a format string with the right size arguments to the %s values
-        if csv:
-            lineformat = "%s,%s,%s,%s"
-        else:
-            lineformat = "%%-%ds  %%-%ds  %%-%ds  %%-%ds  " % (w_date, w_type, w_dest, w_desc)
+        columns = render.Columns(self)
+        lineformat = "%%-%ds  %%-%ds  %%-%ds  %%-%ds  " % (w_date, w_type, w_dest, w_desc)
         output = lineformat % ("DATE", "TYPE", "LOCATION", "DESCRIPTION")
         divider = "%s  %s  %s  %s  " % ("-"*w_date, "-"*w_type, "-"*w_dest, "-"*w_desc)
 
         if total_value:
-            if csv:
-                output += ",VALUE"
-            else:
-                output += "  VALUE   "
+            output += "  VALUE   "
             divider += "-------   "
         else:
-            for account in self.settings.accounts().itervalues():
-                if (account not in self.settings.deleted_account_names()
-                        and self.is_printable(account)):
-                    if csv:
-                        output += ",%s" % (account)
-                    else:
-                        if len(account) > 7:
-                            account = account[0:7]
-                        output += "%7s   " % account # Account names
-                    divider += "-------   "
-                    if print_running_balances:
-                        if csv:
-                            output += ",Balance"
-                        else:
-                            output += "Balance  "
-                        divider += "-------  "
+            for account in columns.names:
+                if len(account) > 7:
+                    account = account[0:7]
+                output += "%7s   " % account # Account names
+                divider += "-------   "
+                if print_running_balances:
+                    output += "Balance  "
+                    divider += "-------  "
         if print_id:
-            if csv:
-                output += ",ID"
-            else:
-                output += "    ID  "
+            output += "    ID  "
             divider += "------  "
-        if csv:
-            output += ",UID\n"
-        else:
-            output += "   UID\n"
+        output += "   UID\n"
         divider += "------\n"
-        if not csv:
-            output += divider
-
-        # Add the records to the database
-        n_rows = 1
-        for record in printable:
-            output += record.__str__(total_value=total_value, print_id=print_id,
-                                     w_type=w_type, w_dest=w_dest, w_desc=w_desc,
-                                     print_balances=print_running_balances, csv=csv)
-            output += "\n"
-            if not csv and n_rows % 5 == 0:
-                output += "\n"
+        output += divider
+        stream.write(output)
+
+        # Write out the records
+        row_format = render.RowFormat(columns, (w_date, w_type, w_dest, w_desc), total_value,
+                                      print_id, print_running_balances)
+        n_rows = 0
+        for record in records():
             n_rows += 1
-        if not csv:
-            output += divider
-
-        # print summary information only when not csv
-        if not csv:
-            # The number of spaces required to line up the Total labels correctly
-            colspace = 2
-            balance_spacing = w_date + w_type + w_dest + w_desc + (colspace*4) - 19
-
-            # Print a line of account totals of visible records
-            output += "%s Total visible:  " % (" "*balance_spacing)
-            if total_value:
-                output += "%9.2f " % balances['visible']['sum']
-            else:
-                for key, value in balances['visible'].iteritems():
-                    if key != 'sum' and self.is_printable(key):
-                        output += "%9.2f " % value
-            output += "\n"
-
-            # Print a line of account totals over all records
-            output += "%s Total balance:  " % (" "*balance_spacing)
-            if total_value:
-                output += "%9.2f " % balances['all']['sum']
+            if n_rows % 5 == 0:
+                stream.write(row_format.line(record) + "\n\n")
             else:
-                for key, value in balances['all'].iteritems():
-                    if key != 'sum' and self.is_printable(key):
-                        output += "%9.2f " % value
-            output += "\n"
+                stream.write(row_format.line(record) + "\n")
+        stream.write(divider)
 
-            vistotal = balances['visible']['sum']
-            total = balances['all']['sum']
-            weekly = balances['thisweek']['sum']
+        # Print summary information
+        # The number of spaces required to line up the Total labels correctly
+        colspace = 2
+        balance_spacing = w_date + w_type + w_dest + w_desc + (colspace*4) - 19
 
-            remaining = self.settings.allowance()+weekly
-            output += "    Visible:    %9.2f   (%d records)\n" % (vistotal, len(printable))
-            output += "    Balance:    %9.2f\n" % total
-            if self.settings.allowance() > 0.0:
-                output += "    This Week:  %9.2f\n" % weekly
-                output += "    Remaining:  %9.2f\n" % remaining
+        # Print a line of account totals of visible records
+        output = "%s Total visible:  " % (" "*balance_spacing)
+        if total_value:
+            output += "%9.2f " % balances['visible']['sum']
+        else:
+            for key, value in balances['visible'].iteritems():
+                if key in columns.allowed:
+                    output += "%9.2f " % value
+        output += "\n"
 
-        return output
+        # Print a line of account totals over all records
+        output += "%s Total balance:  " % (" "*balance_spacing)
+        if total_value:
+            output += "%9.2f " % balances['all']['sum']
+        else:
+            for key, value in balances['all'].iteritems():
+                if key in columns.allowed:
+                    output += "%9.2f " % value
+        output += "\n"
+
+        vistotal = balances['visible']['sum']
+        total = balances['all']['sum']
+        weekly = balances['thisweek']['sum']
+
+        remaining = self.settings.allowance()+weekly
+        output += "    Visible:    %9.2f   (%d records)\n" % (vistotal, n_rows)
+        output += "    Balance:    %9.2f\n" % total
+        if self.settings.allowance() > 0.0:
+            output += "    This Week:  %9.2f\n" % weekly
+            output += "    Remaining:  %9.2f\n" % remaining
+        stream.write(output)
 
     #--------------------------------------------------------------------------
     # Admin functions for editing the database
@@ -192,8 +225,102 @@ class Database(object):
 
     def add(self, record):
         """ Add a Transaction object (record) to the database """
-        self.records.append(record)
+        self.journal.add(record)
+        self.note(cube.entry(record, self.context.accounts), 1)
         self.is_changed = True
+        position = len(self.records)
+        if self.ordered and position > 0:
+            # Keep sorted records in order, so they never need sorting again
+            position = bisect_right(transaction.SortKeys(self.records), transaction.sort_key(record))
+        if position == len(self.records):
+            self.records.append(record)
+            self.changed(position, record)
+        else:
+            self.records.insert(position, record)
+            self.changed(position)
+            # The journal only knows about records, not their order in the file
+            self.needs_rewrite = True
+
+    def add_many(self, records):
+        """ Add a list of Transaction objects, keeping the records in order if they were """
+        accounts = self.context.accounts
+        for record in records:
+            self.journal.add(record)
+            self.note(cube.entry(record, accounts), 1)
+        self.is_changed = True
+        if not records:
+            return
+        position = len(self.records)
+        # Worth finding out for many records at once, unlike in add
+        if self.in_order():
+            records = sorted(records, key=transaction.sort_key)
+            if position > 0:
+                position = bisect_right(transaction.SortKeys(self.records),
+                                        transaction.sort_key(records[0]))
+        if position == len(self.records):
+            # All of them go after the last record, so the indexes can be kept
+            for record in records:
+                self.records.append(record)
+                self.changed(len(self.records) - 1, record)
+        else:
+            # Merging two sorted runs is close to linear, and far quicker than inserting each
+            for record in records:
+                self.records.append(record)
+            self.records.sort(key=transaction.sort_key)
+            self.changed(position)
+            # The journal only knows about records, not their order in the file
+            self.needs_rewrite = True
+
+    def update(self, record, previous=None):
+        """ Note that a record already in the database was changed in place """
+        # previous is the cube.entry of the record from before it was changed
+        self.journal.edit(record)
+        if previous is None:
+            # The cube can't take away what it doesn't know, so it must be worked out again
+            self.cube.reset()
+            self.cube_changes = None
+        else:
+            self.note(previous, -1)
+            self.note(cube.entry(record, self.context.accounts), 1)
+        self.is_changed = True
+        # Changing the record may have moved it out of order
+        self.ordered = None
+        position = self.position(record)
+        if position is None:
+            self.changed()
+        else:
+            self.changed(position, edited=record)
+
+    def changed(self, position=0, added=None, edited=None):
+        """ Note that records from position on changed, or only that one was added or edited """
+        self.version += 1
+        self.visibility = {}
+        self.visibility_order = []
+        self.visible_key = None
+        self.ledger.changed(position)
+        if added is not None:
+            self.indexes.append(added)
+        elif edited is not None:
+            self.indexes.edit(position, edited)
+        else:
+            self.indexes.reset()
+
+    def note(self, item, sign):
+        """ Add (sign 1) or take away (sign -1) a cube entry in the totals of the records """
+        if self.cube.ready:
+            self.cube.apply(item, sign)
+        elif self.cube_changes is not None:
+            # Applied once the stored cube is read
+            self.cube_changes.append((item, sign))
+
+    def position(self, record):
+        """ Return the position of a record in the database, or None if it isn't there """
+        if isinstance(record, table.Row) and record.table is self.records:
+            return record.row
+        for position, other in enumerate(self.records):
+            if other is record:
+                return position
+        return None
 
     def new_record(self):
         """ Make a new record, get user input for it, and add to the database"""
@@ -204,40 +331,76 @@ class Database(object):
             print("\nCaught Keyboard Interrupt. This record has not been added.")
         else:
             self.add(new)
-            #! Would be nice to append this new record to the original database file
-            #! instead of saving the whole thing
-            self.is_changed = True
+
+    def find(self, uid):
+        """ Return the positions of the records with the given uid, in order """
+        return self.indexes.field('uid').postings.get(uid, [])
 
     def edit(self, uid):
         """ Prompt for new values for a record with given uid """
-        for record in self.records:
-            if record.uid == uid:
-                #! As in new_record, would like this to handle Ctrl-C nicely,
-                #! without saving the changes
-                record.input_values()
-                return
-        self.is_changed = True
+        for position in self.find(uid):
+            record = self.records[position]
+            #! As in new_record, would like this to handle Ctrl-C nicely,
+            #! without saving the changes
+            previous = cube.entry(record, self.context.accounts)
+            record.input_values()
+            self.update(record, previous)
+            return
 
     def delete(self, uid, confirm=True):
         """ Delete record specified by uid """
-        for record in self.records:
-            if record.uid == uid:
+        self.delete_many([uid], confirm)
+
+    def delete_many(self, uids, confirm=True):
+        """ Delete the records specified by a list of uids, removing them all at once """
+        doomed = set()
+        for uid in uids:
+            deleted = False
+            for position in self.find(uid):
+                record = self.records[position]
                 if confirm is True:
                     prompt = "Delete record [%s]? (yes/no) " % record.encode()
-                    answer = raw_input(prompt)
-                    if answer == "yes":
-                        # Uses __cmp__ to check when equal
-                        self.records.remove(record)
-                else:
-                    self.records.remove(record)
+                    if raw_input(prompt) != "yes":
+                        continue
+                self.note(cube.entry(record, self.context.accounts), -1)
+                doomed.add(position)
+                deleted = True
+            if deleted:
+                self.journal.delete(uid)
+        if doomed:
+            if isinstance(self.records, table.RecordTable):
+                self.records.delete_rows(doomed)
+            else:
+                self.records[:] = [record for position, record in enumerate(self.records)
+                                   if position not in doomed]
+            self.changed(min(doomed))
         self.is_changed = True
 
+    def in_order(self):
+        """ Return whether the records are already sorted """
+        if self.ordered is None:
+            records = self.records
+            if isinstance(records, table.RecordTable):
+                keys = records.sort_keys()
+                self.ordered = all(imap(le, keys, islice(keys, 1, None)))
+            else:
+                self.ordered = all(imap(transaction.in_order, records, islice(records, 1, None)))
+        return self.ordered
+
     def sort(self, perm=True):
         """ Sorts the records in the database. """
-        self.records.sort()
+        if self.in_order():
+            # Nothing would move, so there is nothing to save either
+            return
+        self.records.sort(key=transaction.sort_key)
+        self.ordered = True
+        self.changed()
         # If database was marked changed by something, leave it marked as such
         if self.is_changed is False:
             self.is_changed = perm
+        # The journal only knows about records, not their order in the file
+        if perm:
+            self.needs_rewrite = True
 
     def encode(self):
         """ Write database out in text file format """
@@ -250,197 +413,192 @@ class Database(object):
     def save(self, outname=""):
         """ Rewrite the database to a txt, overwriting itself by default """
         if outname == "":
+            # Append to the journal instead of rewriting everything, if allowed
+            if (self.settings.journal() and not self.needs_rewrite
+                    and self.journal.size() <= self.settings.journal_limit()):
+                self.journal.flush()
+                return
             outname = self.filename
         outfile = file(outname, 'w')
         outfile.write(self.encode())
         outfile.close()
+        if outname == self.filename:
+            # Everything in the journal is now in the database file itself
+            self.journal.clear()
+            self.needs_rewrite = False
+            self.snapshot.save(self.records, self.settings.accounts(), written=True)
+            if self.cube.ready:
+                self.cube.save(self.settings.accounts())
+            self.cube_changes = []
+
+    def replay(self, action, argument):
+        """ Apply a change read from the journal to the records """
+        accounts = self.context.accounts
+        if action == journal.ADD:
+            record = transaction.Transaction(self, self.settings, argument)
+            self.records.append(record)
+            self.note(cube.entry(record, accounts), 1)
+        elif action == journal.EDIT:
+            record = transaction.Transaction(self, self.settings, argument)
+            self.note(cube.entry(record, accounts), 1)
+            for index, old in enumerate(self.records):
+                if old.uid == record.uid:
+                    self.note(cube.entry(old, accounts), -1)
+                    self.records[index] = record
+                    return
+            # The record must have been removed from the database file by hand
+            self.records.append(record)
+        elif action == journal.DELETE:
+            for index in reversed(xrange(len(self.records))):
+                if self.records[index].uid == argument:
+                    self.note(cube.entry(self.records[index], accounts), -1)
+                    del self.records[index]
+        else:
+            print("Error reading journal: action %s not recognized." % action)
 
     #--------------------------------------------------------------------------
     # Functions for printing information about the database
     #--------------------------------------------------------------------------
 
-    def balances(self):
-        """ Return a list of balances """
+    def summary(self):
+        """ Return the Summary of the records, as currently filtered """
         self.apply_filters()
+        # Totals depend on the settings as well as which records are visible
+        key = (self.visible_key,
+               tuple(self.settings.deleted_account_keys()),
+               self.settings.rates_version)
+        if self.summary_key != key:
+            self.summary_cache = aggregate.Summary(self)
+            self.summary_key = key
+        return self.summary_cache
 
-        balance = {}
-        wbalance = {} # Running balance over last week
-        vbalance = {} # Balance of visible records
+    def balances(self):
+        """ Return a list of balances """
+        balances = self.summary().balances
+        # Copy the totals, so callers can't change the ones kept in the summary
+        return dict((name, dict(totals)) for name, totals in balances.iteritems())
+
+    def footer_balances(self):
+        """ Return the balances printed below the records, as from balances """
+        # The cube has the totals of the visible records without going through them
+        query = self.cube_query()
+        if query is None:
+            return self.balances()
+        return aggregate.cube_balances(self, query)
+
+    def balances_between(self, mindate=None, maxdate=None):
+        """ Return the change in each account from mindate up to but not including maxdate """
+        # Ignores filters
+        balance_index = self.indexes.balances
+        totals = {}
         for acc in self.settings.accounts().iterkeys():
             if acc not in self.settings.deleted_account_keys():
-                balance[acc] = 0.0
-                wbalance[acc] = 0.0
-                vbalance[acc] = 0.0
-
-        for record in self.records:
-            for acc, delta in record.deltas.iteritems():
-                if acc not in self.settings.deleted_account_keys():
-                    balance[acc] += delta
-                    record.set_running_balance(acc, balance[acc])
-            if record.visible is True:
-                for acc, delta in record.deltas.iteritems():
-                    if acc not in self.settings.deleted_account_keys():
-                        if record.date > self.settings.TODAY - self.settings.ONEWEEK:
-                            wbalance[acc] += delta
-                        vbalance[acc] += delta
-
-        # Now add another field for the sum in the default currency
-        balance['sum'] = 0.0
-        vbalance['sum'] = 0.0
-        wbalance['sum'] = 0.0
-        for acc, value in balance.iteritems():
-            # protect against the fact that 'sum' will be one of the accounts...
-            if acc != 'sum':
-                if acc in self.settings.foreign_account_keys():
-                    balance['sum'] += balance[acc]*self.settings.exchange(acc)
-                    vbalance['sum'] += vbalance[acc]*self.settings.exchange(acc)
-                    wbalance['sum'] += wbalance[acc]*self.settings.exchange(acc)
-                else:
-                    balance['sum'] += balance[acc]
-                    vbalance['sum'] += vbalance[acc]
-                    wbalance['sum'] += wbalance[acc]
-
-        # Return the result
-        result = {
-            'all':balance,
-            'visible':vbalance,
-            'thisweek':wbalance
-        }
-        return result
-
-    def balances_by_type(self):
-        """ Return a dictionary of types and their balances """
-        self.apply_filters()
-        balances = {}
-        for record in self.records:
-            if record.visible:
-                if record.type not in balances:
-                    balances[record.type] = record.value()
-                else:
-                    balances[record.type] += record.value()
-
-        balances = sort_balances(balances)
-        return balances # this is a list of tuples
-
-    #! For ByType and ByRecipient, include a field with the number of
-    #! transactions --- will need to rework how these functions are used
-
-    def balances_by_recipient(self):
-        """ Return a list of recipients with the money spent on them """
+                totals[acc] = balance_index.total(self.context.slot(acc), mindate, maxdate)
+        return totals
+
+    def balances_on(self, when):
+        """ Return the balance of each account at the end of the given date """
+        return self.balances_between(None, when + timedelta(1))
+
+    def totals(self):
+        """ Return the Cube of the records, reading or working it out if needed """
+        if not self.cube.ready:
+            if self.cube_changes is not None and self.cube.load(self.settings.accounts()):
+                for item, sign in self.cube_changes:
+                    self.cube.apply(item, sign)
+            else:
+                self.cube.build(self.records, self.context.accounts)
+                if self.cube_changes is not None:
+                    # Keep the totals of the file itself, without the changes since
+                    for item, sign in reversed(self.cube_changes):
+                        self.cube.apply(item, -sign)
+                    self.cube.save(self.settings.accounts())
+                    for item, sign in self.cube_changes:
+                        self.cube.apply(item, sign)
+            self.cube_changes = []
+        return self.cube
+
+    def cube_query(self, visible_only=True):
+        """ Return (cube, mindate, maxdate, match) if the cube can stand in for the records """
+        # match is a test of (type, dest), or None if every pair counts
+        if not self.settings.cube():
+            return None
+        if not visible_only:
+            return (self.totals(), None, None, None)
+        if not filters.cube_compatible(self.filters):
+            return None
+        mindate, maxdate = filters.date_range(self.filters, self.settings)
+        return (self.totals(), mindate, maxdate,
+                filters.compile_cell_filter(self.filters, self.settings))
+
+    def balances_by_type(self, limit=None):
+        """ Return a list of types and their balances, largest first """
+        return sort_balances(self.totals_by('type'), limit)
+
+    def balances_by_recipient(self, limit=None):
+        """ Return a list of recipients with the money spent on them, largest first """
+        return sort_balances(self.totals_by('dest'), limit)
+
+    def totals_by(self, field):
+        """ Return a dictionary of the value of the visible records with each 'type' or 'dest' """
         # Respects filters
-        self.apply_filters()
-        balances = {}
-        for record in self.records:
-            if record.visible:
-                # check that this destination exists yet
-                if record.dest not in balances:
-                    balances[record.dest] = record.value()
-                else:
-                    balances[record.dest] += record.value()
+        query = self.cube_query()
+        if query is not None:
+            return aggregate.cube_totals(self, query, field)
+        if field == 'type':
+            return self.summary().by_type
+        return self.summary().by_recipient
 
-        balances = sort_balances(balances)
-        return balances # this is a list of tuples
+    def group_by(self, keys, aggregates=('sum',)):
+        """ Return a dictionary of group -> tuple of aggregates of the visible records """
+        # See aggregate.group_by
+        return aggregate.group_by(self, keys, aggregates)
 
 
     def integrate_deltas(self, visible_only=True):
         """ Provides actual balance of the accounts as a function of time """
+        return [[when] + balances + [total] for when, balances, total
+                in self.balance_series(visible_only).rows()]
 
-        self.apply_filters()
 
-        values = []
-
-        total = 0.0
-
-        balances = {}
-        for acc in self.settings.accounts().iterkeys():
-            balances[acc] = 0.0
-
-        self.sort(perm=False)
-        date_set = False
-
-        for record in self.records:
-            if (visible_only and record.visible) or visible_only is False:
-                if date_set is False:
-                    current_date = record.date
-                    date_set = True
-                this_date = record.date
-                if this_date == current_date:
-                    for acc, delta in record.deltas.iteritems():
-                        balances[acc] += delta
-                    total += record.value()
-                else:
-                    while this_date != current_date:
-                        this_value = [current_date]
-                        this_value.extend(balances.values())
-                        this_value.append(total)
-                        values.append(this_value)
-                        current_date = current_date+timedelta(1)
-                    for acc, delta in record.deltas.iteritems():
-                        balances[acc] += delta
-                    total += record.value()
-
-        this_value = [current_date]
-        this_value.extend(balances.values())
-        this_value.append(total)
-        values.append(this_value)
-        return values
+    def balance_series(self, visible_only=True):
+        """ Return the Timeseries of the balance of every account, day by day """
+        return aggregate.Timeseries(self, visible_only)
 
 
     def integrate(self, num_days=7, visible_only=True, independent=False):
         """ Return deltas integrated over previous days, 7 by default """
-
-        self.apply_filters()
-
-        values = []
-
-        # Declare the array we will hold intermediate values in
-        #! This could be extended to keep track of each separate account
-        dtotals = []
-        for i in range(0, num_days):
-            dtotals.append(0.0)
-
-        # We require the transactions to be in chronological order
-        self.sort(perm=False)
-
-        i = 0 # index of dtotals, should go from 0 to n-1
-        days_done = 0 # counts days done so far
-        date_set = False # Need to find first visible record before setting date
-
-        for record in self.records:
-            if (visible_only and record.visible) or visible_only is False:
-                if date_set is False:
-                    # Get the date of the first record we're actually printing
-                    current_date = record.date
-                    date_set = True
-                this_date = record.date
-                if this_date == current_date:
-                    dtotals[i] += record.value()
-
-                else:
-                    while this_date != current_date:
-
-                        # Go on to the next day
-                        if days_done >= (num_days - 1):
-                            # Print every day if we don't care about keeping points independent
-                            # Else just print every nth point
-                            if (not independent) or (days_done % num_days == num_days - 1):
-                                values.append((current_date, sum(dtotals)))
-                        i = (i + 1) % num_days
-                        current_date = current_date + timedelta(1)
-                        # If still not at the right day, set this day to 0 value
-                        if current_date != this_date:
-                            dtotals[i] = 0.0
-                        days_done += 1
-
-                    # Now we have the correct day, add it
-                    dtotals[i] = record.value()
-
-        if days_done >= num_days:
-            if (not independent) or (days_done % num_days == num_days - 1):
-                values.append((current_date, sum(dtotals)))
-
-        return values
-    #! The above stops on the last record, not the last day in the range
+        return [(day, totals[0]) for day, totals
+                in self.integrate_windows([num_days], visible_only, independent)]
+
+
+    def integrate_windows(self, windows, visible_only=True, independent=False):
+        """ Return (date, list of the total value of the last n days for each n in windows) """
+
+        days = aggregate.day_values(self, visible_only)
+        if not days:
+            return []
+
+        # Every day from the first record to the end of the range or today, whichever
+        # is first, even without records. Days after today have nothing to add up,
+        # unless there are records dated then.
+        first = min(days)
+        mindate, maxdate = filters.date_range(self.filters, self.settings)
+        last = self.settings.TODAY.toordinal()
+        if maxdate is not None:
+            last = min(last, (maxdate - timedelta(1)).toordinal())
+        last = max(last, max(days))
+        values = aggregate.daily(days, first, last)
+
+        sums = [aggregate.moving_sums(values, num_days) for num_days in windows]
+        # Only include days with a full window of days before them
+        widest = max(windows)
+        result = []
+        for index in xrange(widest - 1, len(values)):
+            # If we care about keeping points independent, just include every nth point
+            if (not independent) or (index % widest == widest - 1):
+                result.append((date.fromordinal(first + index), [totals[index] for totals in sums]))
+        return result
 
 
     def predict_destination(self, expense_type, num=1):
@@ -514,188 +672,111 @@ class Database(object):
         """ Set filters back to their defaults """
         self.filters = self.settings.filters()
 
+    def maxprint(self):
+        """ Return the most records or totals to print at a time, or None for no limit """
+        if "maxprint" in self.filters:
+            limit = self.filters['maxprint']
+        else:
+            limit = self.settings.maxprint()
+        # -N 0 has always meant no limit
+        if limit is not None and limit <= 0:
+            return None
+        return limit
+
+    def select_dates(self, mindate=None, maxdate=None):
+        """ Return a mask of the records from mindate up to but not including maxdate """
+        inside = bytearray(len(self.records))
+        for row in self.indexes.dates.between(mindate, maxdate):
+            inside[row] = True
+        return inside
 
-    # Filter behaviour may be inconsistent...
-    def filter_type(self, expense_type, flag=True):
-        """ Filter records that match type """
-        # Check if the first character is a negation
-        if str.find(expense_type, self.settings.not_character()) == 0:
-            flag = not flag
-            expense_type = expense_type[1:]
-        types = str.split(expense_type, ',')
-        for record in self.records:
-            if record.visible and (record.type in types):
-                record.visible = flag
-            elif record.visible:
-                record.visible = not flag
-
-    def filter_recipient(self, dest, flag=True):
-        """ Filter records that match recipient """
-        recips = str.split(dest, ',')
-        for record in self.records:
-            if record.visible and (record.dest in recips):
-                record.visible = flag
-            elif record.visible:
-                record.visible = not flag
-
-    def filter_uid(self, uid, flag=True):
-        """ Filter for specific UID and only UID"""
-        for record in self.records:
-            if record.visible and record.uid == uid:
-                record.visible = flag
-            elif record.visible:
-                record.visible = not flag
-
-    def filter_string(self, needle, flag=True):
-        """ Filter according to whether record description contains a string """
-        for record in self.records:
-            if record.visible:
-                if record.desc.find(needle) >= 0 or record.dest.find(needle) >= 0:
-                    record.visible = flag
-                else:
-                    record.visible = not flag
-
-    def filter_week(self, num_weeks=1):
-        """ Filter out records older than n weeks (default n=1) from today"""
-        for record in self.records:
-            if (record.date <= self.settings.TODAY - self.settings.ONEWEEK*num_weeks
-                    or record.date > self.settings.TODAY):
-                record.visible = False
+    def apply_filters(self):
+        """ Apply the entire filters dictionary to the database """
+        filters.report(self.filters, self.settings)
 
-    def filter_value(self, valmin=None, valmax=None, flag=True):
-        """ Filter out records with less than total abs(value) val """
-        if valmin is None and valmax is None:
+        # Nothing to do if the same filters were applied to the same records last time
+        key = (self.version, filters.canonical(self.filters, self.settings))
+        if key == self.visible_key:
+            return
+        if key in self.visibility:
+            self.set_visibility(self.visibility[key])
+            self.visible_key = key
+            self.visible_mask = self.visibility[key]
             return
-        for record in self.records:
-            if record.visible:
-                if valmin != None and record.value() < valmin:
-                    record.visible = not flag
-                if valmax != None and record.value() > valmax:
-                    record.visible = not flag
-
-    def filter_account(self, account_string, flag=True):
-        """ Filter by requiring account delta is non-zero """
-
-        accounts = str.split(account_string, ',')
-        for account in accounts:
-            # Get index of account we want. Will be same index as delta array.
-            if account in self.settings.account_names():
-                # Given the name we must find the key
-                 # KERROR should never survive loop below since we already know the name exists
-                key = 'KERROR'
-                for acc, name in self.settings.accounts().iteritems():
-                    if name == account:
-                        key = acc
-                # Now find records with non-zero deltas for this account
-                for record in self.records:
-                    if key in record.deltas:
-                        if record.deltas[key] != 0.0 and record.visible:
-                            record.visible = flag
-                    elif record.visible:
-                        record.visible = not flag
-            else:
-                print('Account %s does not exist' % account)
-
-
-    def filter_date(self, mindate, maxdate=None, flag=True):
-        """ Include anything between mindate up to but not including maxdate """
-        # Takes two DATES for now
-
-        if maxdate is None:
-            maxdate = self.settings.TODAY+timedelta(1)
-
-        for record in self.records:
-            if record.visible:
-                if record.date < mindate or record.date >= maxdate:
-                    record.visible = not flag
-
-    def filter_reset(self):
-        """ Reset all records to print """
-        # Not to be confused with reset_filters, which changes filters dictionary
-        for record in self.records:
-            record.visible = True
-
-    def filter_invert(self):
-        """ Invert the current filters """
-        for record in self.records:
-            record.visible = not record.visible
 
-    def apply_filters(self):
-        """ Apply the entire filters dictionary to the database """
-        self.filter_reset()
-
-        # Apply the date filter
-        if self.filters['dates'] != None:
-            if str.find(self.filters['dates'], 'W') == 0:
-                # If filter starts with w, filter to number of weeks specified
-                # e.g. w52 for one year
-                self.filter_week(int(self.filters['dates'][1:]))
-            else:
-                # Else we should have the yyyy-mm-dd,yyyy-mm-dd format
-                # Get the two possible arguments
-                args = str.split(self.filters['dates'], ",")
-
-                # Get the first date
-                mindate = str.split(args[0], "-")
-                mindate = date(int(mindate[0]), int(mindate[1]), int(mindate[2]))
-
-                # Look for second date, and use it to set filter if it's there
-                if len(args) == 2 and args[1]:
-                    maxdate = str.split(args[1], "-")
-                    maxdate = date(int(maxdate[0]), int(maxdate[1]), int(maxdate[2]))
-                    self.filter_date(mindate, maxdate)
+        # Find the records in the date range from the index, then test only those
+        mindate, maxdate = filters.date_range(self.filters, self.settings)
+        if mindate is None and maxdate is None:
+            rows = xrange(len(self.records))
+        else:
+            rows = self.indexes.dates.between(mindate, maxdate)
+
+        # Filters answered by an index, rather than by testing each record. Building
+        # an index costs about as much as testing every record once, so only do it
+        # when most of the records would be tested anyway.
+        length = len(self.records)
+        wide = len(rows)*2 >= length
+        selections = [] # (mask, whether records must be in it)
+        indexed = []
+        if self.filters['recipients'] is not None and (wide or self.indexes.built('dest')):
+            recipients = set(str.split(self.filters['recipients'], ','))
+            selections.append((self.indexes.field('dest').select(recipients, length), True))
+            indexed.append('recipients')
+        if self.filters['types'] is not None and (wide or self.indexes.built('type')):
+            expense_types, include = filters.type_names(self.filters, self.settings)
+            selections.append((self.indexes.field('type').select(expense_types, length), include))
+            indexed.append('types')
+        if self.filters['accounts'] is not None:
+            slots = filters.account_slots(self.filters, self.settings, self.context)
+            if wide or all(self.indexes.has_account(slot) for slot in slots):
+                for slot in slots:
+                    selections.append((index.select(self.indexes.account(slot), length), True))
+                indexed.append('accounts')
+        if self.filters['string'] is not None and self.settings.text_index():
+            needle, include = filters.string_needle(self.filters, self.settings)
+            selections.append((self.indexes.text.search(needle, length), include))
+            indexed.append('string')
+        for selected, include in selections:
+            rows = [row for row in rows if selected[row] == include]
+
+        tests = filters.compile_filters(self.filters, self.settings, self.context, indexed)
+        visibles = bytearray(len(self.records))
+        if not tests:
+            for row in rows:
+                visibles[row] = True
+        elif isinstance(self.records, table.RecordTable):
+            for row in rows:
+                record = table.Row(self.records, row)
+                for test in tests:
+                    if not test(record):
+                        break
                 else:
-                    self.filter_date(mindate)
-
-        # Apply the accounts filter
-        if self.filters['accounts'] != None:
-            # We print only the account in the string
-            self.filter_account(self.filters['accounts'])
-
-        # Apply the filter by type
-        if self.filters['types'] != None:
-            self.filter_type(self.filters['types'])
-
-        # Apply the filter by recipient
-        if self.filters['recipients'] != None:
-            self.filter_recipient(self.filters['recipients'])
-
-        # Apply the desc/dest string filter
-        if self.filters['string'] != None:
-            #! Can we put multiple string filters in filter dictionary at once?
-            #! eg for filter in self.filters['string']...
-            if self.filters['string'][0] == self.settings.not_character():
-                self.filter_string(self.filters['string'][1:], flag=False)
-            else:
-                self.filter_string(self.filters['string'])
-
-        if self.filters['values'] != None:
-            values = str.split(self.filters['values'], ',')
-            if values[0] == '':
-                values[0] = None
-            else:
-                values[0] = float(values[0])
-            if len(values) > 1:
-                if values[1] == '':
-                    values[1] = None
+                    visibles[row] = True
+        else:
+            for row in rows:
+                record = self.records[row]
+                for test in tests:
+                    if not test(record):
+                        break
                 else:
-                    values[1] = float(values[1])
-            else:
-                values.append(None) # add a values[1] spot
-
-            # If values are out of order, flip them
-            if (values[0] != None) and (values[1] != None) and (values[1] < values[0]):
-                minval = values[1]
-                values[1] = values[0]
-                values[0] = minval
-
-            self.filter_value(values[0], values[1])
-
-        # Remove the UIDs listed
-        if self.filters['uid'] != None:
-            uids = str.split(self.filters['uid'], ',')
-            for uid in uids:
-                self.filter_uid(uid, False)
+                    visibles[row] = True
+        self.set_visibility(visibles)
+
+        # Remember the result, forgetting the oldest if there are too many
+        if len(self.visibility_order) >= filters.CACHE_SIZE:
+            del self.visibility[self.visibility_order.pop(0)]
+        self.visibility[key] = visibles
+        self.visibility_order.append(key)
+        self.visible_key = key
+        self.visible_mask = visibles
+
+    def set_visibility(self, visibles):
+        """ Set the visibility of every record from a bytearray """
+        if isinstance(self.records, table.RecordTable):
+            self.records.visibles = bytearray(visibles)
+        else:
+            for record, visible in izip(self.records, visibles):
+                record.visible = bool(visible)
 
 
     def is_printable(self, name):
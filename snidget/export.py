@@ -0,0 +1,175 @@
+""" Write the records of a database to other formats a record at a time, and read them back."""
+
+from __future__ import print_function
+import csv
+import json
+from array import array
+from itertools import compress
+
+from snidget import render, transaction, filters, index
+
+# The text table is for reading in a terminal, so it only shows the most recent
+# records and works out column widths first. An export is for other programs,
+# so every visible record is written, each row as soon as it is made, and the
+# memory used does not depend on how many records there are. The fields of a
+# CSV export can be picked and put in any order; "accounts" and "balances" each
+# stand for a column per account shown, respecting the columns filter.
+
+# JSON Lines has one record on each line, as an object with the date, type,
+# location, description, id, uid, value and deltas, keyed by account name for
+# every account and not just those shown. Reading it back looks the account
+# names up once for the whole file, then makes the records straight from their
+# fields, as the snapshot does, and adds them to the database all at once.
+
+# Fields that can be written in a CSV export
+CSV_FIELDS = ['date', 'type', 'location', 'description', 'value', 'accounts', 'balances',
+              'id', 'uid']
+
+
+def csv_fields(database):
+    """ Return the fields written when none are asked for, as the text table shows them """
+    fields = ['date', 'type', 'location', 'description']
+    fields.append('value' if database.settings.total_values() else 'accounts')
+    # Don't write the ID column unless there is data there
+    visible = compress(database.records, database.visible_mask)
+    if any(record.id != "" for record in visible):
+        fields.append('id')
+    fields.append('uid')
+    return fields
+
+
+def write_csv(database, stream, fields=None):
+    """ Write the visible records of a database to a stream as CSV, with a header line """
+    database.apply_filters()
+    if fields is None:
+        fields = csv_fields(database)
+    if 'balances' in fields:
+        # Running balances are worked out along with the balance of each account
+        database.ledger.balances()
+    columns = render.Columns(database)
+    slots = columns.slots
+
+    header = []
+    for field in fields:
+        if field == 'accounts':
+            header.extend(columns.names)
+        elif field == 'balances':
+            header.extend("%s Balance" % name for name in columns.names)
+        else:
+            header.append(field.upper())
+
+    def accounts(record):
+        """ The change in each account shown """
+        amounts = record.amounts
+        return ["%f" % (amounts[slot] if slot < len(amounts) else 0.0) for slot in slots]
+
+    def balances(record):
+        """ The running balance of each account shown, blank where it didn't change """
+        amounts = record.amounts
+        running = record.balances
+        return ["%f" % running[slot] if slot < len(amounts) and amounts[slot]
+                and running is not None and slot < len(running) else ""
+                for slot in slots]
+
+    getters = {
+        'date': lambda record: [record.date],
+        'type': lambda record: [record.type],
+        'location': lambda record: [record.dest],
+        'description': lambda record: [record.desc],
+        'value': lambda record: ["%f" % record.value()],
+        'accounts': accounts,
+        'balances': balances,
+        'id': lambda record: [record.id],
+        'uid': lambda record: [record.uid],
+        }
+    row_getters = [getters[field] for field in fields]
+
+    writer = csv.writer(stream, lineterminator="\n")
+    writer.writerow(header)
+    for record in compress(database.records, database.visible_mask):
+        row = []
+        for getter in row_getters:
+            row.extend(getter(record))
+        writer.writerow(row)
+
+
+def write_jsonl(database, stream):
+    """ Write the visible records of a database to a stream as JSON, one record to a line """
+    database.apply_filters()
+    # Deltas in accounts missing from the settings are written with their keys
+    accounts = database.settings.accounts()
+    names = [accounts.get(acc, acc) for acc in database.context.accounts]
+    # Sorting the keys would rule out the much quicker C encoder
+    encoder = json.JSONEncoder()
+    for record in compress(database.records, database.visible_mask):
+        amounts = record.amounts
+        deltas = dict((names[slot], amounts[slot])
+                      for slot in compress(xrange(len(amounts)), amounts))
+        fields = {'date': str(record.date), 'type': record.type, 'location': record.dest,
+                  'description': record.desc, 'deltas': deltas, 'value': record.value(),
+                  'id': record.id, 'uid': record.uid}
+        stream.write(encoder.encode(fields) + "\n")
+
+
+def text(fields, name):
+    """ Return a string field of a JSON record, which can't break the database file """
+    value = fields.get(name, "")
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if not isinstance(value, str):
+        raise ValueError("%s is not a string" % name)
+    if "|" in value or "\n" in value:
+        raise ValueError("%s contains | or a newline" % name)
+    return value
+
+
+def read_jsonl(database, stream):
+    """ Add the records in a stream of JSON lines to a database, returning the number added """
+    context = database.context
+    # Account names are looked up here once, rather than for each delta of each record
+    slots = dict((name, context.slot(acc))
+                 for acc, name in database.settings.accounts().iteritems())
+    uids = set(index.field(database.records, 'uid'))
+    records = []
+    errors = 0
+    skipped = 0
+    for number, line in enumerate(stream, 1):
+        if line.strip() == "":
+            continue
+        try:
+            fields = json.loads(line)
+            if not isinstance(fields, dict):
+                raise ValueError("not an object")
+            uid = text(fields, 'uid')
+            if uid == "":
+                raise ValueError("no uid")
+            amounts = array('d', [0.0]) * len(context.accounts)
+            for name, delta in fields.get('deltas', {}).iteritems():
+                # The settings hold names as UTF-8 strings, while json gives unicode
+                if isinstance(name, unicode):
+                    name = name.encode('utf-8')
+                if name not in slots:
+                    raise ValueError("account %s does not exist" % name)
+                amounts[slots[name]] = float(delta)
+            record = transaction.from_fields(context, filters.parse_date(text(fields, 'date')),
+                                             text(fields, 'type'), text(fields, 'location'),
+                                             text(fields, 'description'), amounts,
+                                             text(fields, 'id'), uid)
+        except (ValueError, TypeError, IndexError, AttributeError) as error:
+            print("Line %d: %s" % (number, error))
+            errors += 1
+            continue
+        if uid in uids:
+            # Importing the same records twice leaves only one copy
+            skipped += 1
+            continue
+        uids.add(uid)
+        records.append(record)
+
+    if errors:
+        print("Nothing imported, %d lines could not be read." % errors)
+        return 0
+    if skipped:
+        print("Skipped %d records already in the database." % skipped)
+    database.add_many(records)
+    return len(records)
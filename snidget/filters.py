@@ -0,0 +1,201 @@
+""" Turn the filters dictionary into tests which decide whether a record is visible."""
+
+from __future__ import print_function
+from datetime import date, timedelta
+
+# Applying each filter as a separate pass over the database means walking every
+# record up to seven times. Instead the filters dictionary is compiled once into
+# a date range and a short list of tests, and a record is visible only if it is
+# inside the date range and passes every test. Tests are ordered so the cheap
+# ones most likely to hide a record come first, so most records are decided
+# after one or two of them.
+
+
+# The filters which decide which records are visible, as opposed to how they are printed
+VISIBILITY = ['dates', 'accounts', 'types', 'recipients', 'string', 'values', 'uid']
+
+# Number of recently applied filters whose results are remembered by the database
+CACHE_SIZE = 8
+
+# Lists where the order of the items makes no difference to the result
+UNORDERED = ['accounts', 'types', 'recipients', 'uid']
+
+# Filters which only look at the date, type and location of a record, so the
+# totals kept by a Cube can be used instead of the records themselves
+CUBE = ['dates', 'types', 'recipients']
+
+
+def canonical(filters, settings):
+    """ Return a tuple which is the same for any two filters showing the same records """
+    key = []
+    for filt in VISIBILITY:
+        value = filters.get(filt)
+        if value is not None and filt in UNORDERED:
+            negate = ''
+            if filt == 'types' and str.find(value, settings.not_character()) == 0:
+                negate = settings.not_character()
+                value = value[1:]
+            value = negate + ','.join(sorted(set(str.split(value, ','))))
+        key.append(value)
+    # Settings which change what some of the filters mean
+    key.append(settings.not_character())
+    if filters.get('accounts') is not None:
+        key.append(tuple(sorted(settings.accounts().items())))
+    if filters.get('values') is not None:
+        key.append(settings.rates_version)
+    return tuple(key)
+
+
+def parse_date(string):
+    """ Convert a yyyy-mm-dd string to a date """
+    fields = str.split(string, "-")
+    return date(int(fields[0]), int(fields[1]), int(fields[2]))
+
+
+def date_range(filters, settings):
+    """ Return (mindate, maxdate) allowed by the dates filter, including mindate but not maxdate """
+    if filters['dates'] is None:
+        return (None, None)
+
+    if str.find(filters['dates'], 'W') == 0:
+        # If filter starts with w, filter to number of weeks specified
+        # e.g. w52 for one year
+        num_weeks = int(filters['dates'][1:])
+        return (settings.TODAY - settings.ONEWEEK*num_weeks + timedelta(1),
+                settings.TODAY + timedelta(1))
+
+    # Else we should have the yyyy-mm-dd,yyyy-mm-dd format
+    args = str.split(filters['dates'], ",")
+    mindate = parse_date(args[0])
+    if len(args) == 2 and args[1]:
+        maxdate = parse_date(args[1])
+    else:
+        maxdate = settings.TODAY + timedelta(1)
+    return (mindate, maxdate)
+
+
+def value_range(filters):
+    """ Return (valmin, valmax) allowed by the values filter, either may be None """
+    values = str.split(filters['values'], ',')
+    if values[0] == '':
+        values[0] = None
+    else:
+        values[0] = float(values[0])
+    if len(values) > 1:
+        if values[1] == '':
+            values[1] = None
+        else:
+            values[1] = float(values[1])
+    else:
+        values.append(None) # add a values[1] spot
+
+    # If values are out of order, flip them
+    if (values[0] != None) and (values[1] != None) and (values[1] < values[0]):
+        return (values[1], values[0])
+    return (values[0], values[1])
+
+
+def report(filters, settings):
+    """ Print a warning for anything in the filters which can never match """
+    if filters['accounts'] != None:
+        for account in str.split(filters['accounts'], ','):
+            if account not in settings.account_names():
+                print('Account %s does not exist' % account)
+
+
+def type_names(filters, settings):
+    """ Return the set of types filtered on, and whether records must have or lack them """
+    expense_types = filters['types']
+    # Check if the first character is a negation
+    include = True
+    if str.find(expense_types, settings.not_character()) == 0:
+        include = False
+        expense_types = expense_types[1:]
+    return (set(str.split(expense_types, ',')), include)
+
+
+def account_slots(filters, settings, context):
+    """ Return the slots of the accounts filtered on, ignoring unknown accounts """
+    slots = []
+    for account in str.split(filters['accounts'], ','):
+        if account in settings.account_names():
+            slots.append(context.slot(settings.account_key(account)))
+    return slots
+
+
+def string_needle(filters, settings):
+    """ Return the string searched for, and whether records must contain or lack it """
+    needle = filters['string']
+    if needle[0] == settings.not_character():
+        return (needle[1:], False)
+    return (needle, True)
+
+
+def cube_compatible(filters):
+    """ Return whether the visible records can be found from their date, type and location """
+    for filt in VISIBILITY:
+        if filt not in CUBE and filters[filt] is not None:
+            return False
+    return True
+
+
+def compile_cell_filter(filters, settings):
+    """ Return a test of (type, dest) for the types and recipients filters, or None """
+    tests = []
+    if filters['recipients'] != None:
+        recipients = set(str.split(filters['recipients'], ','))
+        tests.append(lambda key: key[1] in recipients)
+    if filters['types'] != None:
+        expense_types, include = type_names(filters, settings)
+        tests.append(lambda key: (key[0] in expense_types) == include)
+    if not tests:
+        return None
+    return lambda key: all(test(key) for test in tests)
+
+
+def compile_filters(filters, settings, context, indexed=()):
+    """ Return the tests a record must pass to be visible, besides its date and anything indexed """
+    tests = []
+
+    # Recipients and types are a single set lookup and usually hide most records
+    if filters['recipients'] != None and 'recipients' not in indexed:
+        recipients = set(str.split(filters['recipients'], ','))
+        tests.append(lambda record: record.dest in recipients)
+
+    if filters['types'] != None and 'types' not in indexed:
+        expense_types, include = type_names(filters, settings)
+        tests.append(lambda record: (record.type in expense_types) == include)
+
+    # Records must have a non-zero delta in every account listed
+    if filters['accounts'] != None and 'accounts' not in indexed:
+        slots = account_slots(filters, settings, context)
+        if slots:
+            def has_accounts(record):
+                """ Check for non-zero deltas in all the requested accounts """
+                amounts = record.amounts
+                for slot in slots:
+                    if slot >= len(amounts) or amounts[slot] == 0.0:
+                        return False
+                return True
+            tests.append(has_accounts)
+
+    # Searching strings and working out values cost more, so they come last
+    if filters['string'] != None and 'string' not in indexed:
+        needle, include = string_needle(filters, settings)
+        tests.append(lambda record: (needle in record.desc or needle in record.dest) == include)
+
+    if filters['values'] != None:
+        valmin, valmax = value_range(filters)
+        if valmin is not None and valmax is not None:
+            tests.append(lambda record: valmin <= record.value() <= valmax)
+        elif valmin is not None:
+            tests.append(lambda record: record.value() >= valmin)
+        elif valmax is not None:
+            tests.append(lambda record: record.value() <= valmax)
+
+    # Excluded UIDs rarely hide anything, so they go at the end
+    if filters['uid'] != None:
+        uids = set(str.split(filters['uid'], ','))
+        tests.append(lambda record: record.uid not in uids)
+
+    return tests
@@ -191,11 +191,11 @@ class SnidgetGUI(object):
                         record.deltas[self.settings.visible_account_keys()[ind]] = value*-1.0
             record.id = entry_id.get_text()
 
+            #! Dialog might have completed correctly without changes
             if is_new:
                 self.database.add(record)
-
-            #! Dialog might have completed correctly without changes
-            self.database.is_changed = True
+            else:
+                self.database.update(record)
 
             self.set_status("Added record with UID %s" % record.uid)
             #! Would be nice to only update the one row
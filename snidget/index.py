@@ -0,0 +1,339 @@
+""" Indexes over the records of a database, so filters need not scan every record."""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import chain, compress, imap, islice, izip
+from operator import le
+from snidget import table
+
+# Most filters only care about a small part of the database, usually the last
+# week or so of records. The indexes here are kept beside the records by the
+# Database, and answer questions like "which records are from January" without
+# looking at the others. Indexes refer to records by their position, so they
+# are built when first needed, kept up to date as records are added at the end,
+# and thrown away whenever records are edited, removed, or reordered.
+
+
+def ordinals(records):
+    """ Return an array with the date of every record as an ordinal """
+    if isinstance(records, table.RecordTable):
+        return records.dates
+    return array('l', (record.date.toordinal() for record in records))
+
+
+class DateIndex(object):
+    """ DateIndex class, the positions of records in order of date """
+    def __init__(self, records):
+        """ Create the index of a list of records """
+        days = ordinals(records)
+        if all(imap(le, days, islice(days, 1, None))):
+            # Records are almost always in order of date already
+            self.rows = array('l', xrange(len(days)))
+            self.days = array('l', days)
+        else:
+            self.rows = array('l', sorted(xrange(len(days)), key=days.__getitem__))
+            self.days = array('l', (days[row] for row in self.rows))
+
+    def append(self, row, day):
+        """ Add the record at position row, with date given as an ordinal """
+        spot = bisect_right(self.days, day)
+        self.days.insert(spot, day)
+        self.rows.insert(spot, row)
+
+    def between(self, mindate=None, maxdate=None):
+        """ Return positions of records from mindate up to but not including maxdate """
+        low = 0
+        high = len(self.days)
+        if mindate is not None:
+            low = bisect_left(self.days, mindate.toordinal())
+        if maxdate is not None:
+            high = bisect_left(self.days, maxdate.toordinal())
+        return self.rows[low:high]
+
+
+def field(records, name):
+    """ Return an iterator over the type, dest or uid of every record """
+    if isinstance(records, table.RecordTable):
+        if name == 'uid':
+            return iter(records.uids)
+        return imap(records.strings.__getitem__, getattr(records, name + 's'))
+    return (getattr(record, name) for record in records)
+
+
+def nonzero(records, slot):
+    """ Return an array of the positions of records with a non-zero delta in a slot """
+    if isinstance(records, table.RecordTable):
+        records.columns()
+        column = records.deltas[slot]
+    else:
+        column = (slot < len(record.amounts) and record.amounts[slot] for record in records)
+    return array('l', compress(xrange(len(records)), column))
+
+
+def select(rows, length):
+    """ Return a mask of the given positions """
+    found = bytearray(length)
+    for row in rows:
+        found[row] = True
+    return found
+
+
+class PostingIndex(object):
+    """ PostingIndex class, the positions of the records having each value of a field """
+    def __init__(self, pairs):
+        """ Create the index from (position, value) pairs """
+        self.postings = {} # value -> array of positions
+        for row, value in pairs:
+            self.append(row, value)
+
+    def append(self, row, value):
+        """ Note that the record at position row has the given value """
+        if value not in self.postings:
+            self.postings[value] = array('l')
+        self.postings[value].append(row)
+
+    def select(self, values, length):
+        """ Return a mask of the records having any of the values """
+        return select(chain.from_iterable(self.postings.get(value, ()) for value in values), length)
+
+
+def trigrams(string):
+    """ Return the set of three character pieces of a string """
+    return set(string[start:start+3] for start in xrange(len(string) - 2))
+
+
+def text_fields(records):
+    """ Return an iterator over the (description, location) of every record """
+    if isinstance(records, table.RecordTable):
+        strings = records.strings
+        return izip(imap(strings.__getitem__, records.descs),
+                    imap(strings.__getitem__, records.dests))
+    return ((record.desc, record.dest) for record in records)
+
+
+class TextIndex(object):
+    """ TextIndex class, finding records whose description or location contain a string """
+    def __init__(self, records):
+        """ Create the index of a list of records """
+        self.postings = {} # string -> array of positions of records with it as desc or dest
+        self.grams = {}    # trigram -> set of strings containing it
+        for row, (desc, dest) in enumerate(text_fields(records)):
+            self.append(row, desc, dest)
+
+    def append(self, row, desc, dest):
+        """ Add the record at position row, with the given description and location """
+        for string in set([desc, dest]):
+            if string not in self.postings:
+                self.postings[string] = array('l')
+                for gram in trigrams(string):
+                    self.grams.setdefault(gram, set()).add(string)
+            self.postings[string].append(row)
+
+    def strings(self, needle):
+        """ Return the set of descriptions and locations which contain needle """
+        if len(needle) < 3:
+            # Too short to have any trigrams, so check every string
+            candidates = self.postings.iterkeys()
+        else:
+            candidates = None
+            # Start from the rarest trigram so the intersection stays small
+            for gram in sorted(trigrams(needle), key=lambda gram: len(self.grams.get(gram, ()))):
+                if gram not in self.grams:
+                    return set()
+                if candidates is None:
+                    candidates = set(self.grams[gram])
+                else:
+                    candidates &= self.grams[gram]
+        # Having every trigram does not mean they are in the right order
+        return set(string for string in candidates if needle in string)
+
+    def search(self, needle, length):
+        """ Return a mask of the records whose description or location contain needle """
+        strings = self.strings(needle)
+        return select(chain.from_iterable(self.postings[string] for string in strings), length)
+
+
+def delta_column(records, slot):
+    """ Return an array of the delta of every record in a slot """
+    if isinstance(records, table.RecordTable):
+        records.columns()
+        return records.deltas[slot]
+    return array('d', (record.amounts[slot] if slot < len(record.amounts) else 0.0
+                       for record in records))
+
+
+def fenwick(values):
+    """ Return a Fenwick tree of the values, counting from 1 """
+    tree = array('d', [0.0])
+    tree.extend(values)
+    for node in xrange(1, len(tree)):
+        parent = node + (node & -node)
+        if parent < len(tree):
+            tree[parent] += tree[node]
+    return tree
+
+
+def prefix(tree, count):
+    """ Return the sum of the first count values in a Fenwick tree """
+    total = 0.0
+    while count > 0:
+        total += tree[count]
+        count -= count & -count
+    return total
+
+
+class BalanceIndex(object):
+    """ BalanceIndex class, the sums of each account's deltas up to any date """
+    # Deltas are kept in order of date, each account with a Fenwick tree of
+    # them, so the sum of any run of records takes a logarithmic number of steps
+    # and changing a delta takes as many to update.
+
+    def __init__(self, records, dates, slots):
+        """ Create the index of the records, using their DateIndex """
+        self.days = array('l', dates.days)
+        self.rows = array('l', dates.rows)
+        self.spots = array('l', [0]) * len(self.rows) # row -> position in order of date
+        for spot, row in enumerate(self.rows):
+            self.spots[row] = spot
+        self.deltas = [] # deltas of each slot in order of date
+        self.trees = []
+        for slot in xrange(slots):
+            column = delta_column(records, slot)
+            self.deltas.append(array('d', imap(column.__getitem__, self.rows)))
+            self.trees.append(fenwick(self.deltas[-1]))
+
+    def append(self, row, record):
+        """ Add the record at position row, returning False if it can't be added """
+        day = record.date.toordinal()
+        amounts = record.amounts
+        if self.days and day < self.days[-1]:
+            return False # would go in the middle, so build the index again
+        if any(amounts[len(self.trees):]):
+            return False
+        self.days.append(day)
+        self.rows.append(row)
+        self.spots.append(len(self.rows) - 1)
+        node = len(self.rows)
+        for slot, tree in enumerate(self.trees):
+            delta = amounts[slot] if slot < len(amounts) else 0.0
+            self.deltas[slot].append(delta)
+            # A new node holds the sum of the values since the node it follows
+            tree.append(delta + prefix(tree, node - 1) - prefix(tree, node - (node & -node)))
+        return True
+
+    def edit(self, row, record):
+        """ Update the record at position row, returning False if it can't be updated """
+        spot = self.spots[row]
+        amounts = record.amounts
+        if record.date.toordinal() != self.days[spot] or any(amounts[len(self.trees):]):
+            return False
+        for slot, tree in enumerate(self.trees):
+            delta = amounts[slot] if slot < len(amounts) else 0.0
+            change = delta - self.deltas[slot][spot]
+            if change != 0.0:
+                self.deltas[slot][spot] = delta
+                node = spot + 1
+                while node < len(tree):
+                    tree[node] += change
+                    node += node & -node
+        return True
+
+    def total(self, slot, mindate=None, maxdate=None):
+        """ Return the sum of the deltas in a slot from mindate up to but not including maxdate """
+        if slot >= len(self.trees):
+            return 0.0
+        low = 0
+        high = len(self.days)
+        if mindate is not None:
+            low = bisect_left(self.days, mindate.toordinal())
+        if maxdate is not None:
+            high = bisect_left(self.days, maxdate.toordinal())
+        if high <= low:
+            return 0.0
+        return prefix(self.trees[slot], high) - prefix(self.trees[slot], low)
+
+
+class Indexes(object):
+    """ Indexes class, holding the indexes of a database until the records change """
+    def __init__(self, database):
+        """ Create the (empty) indexes of a database """
+        self.database = database
+        self.date_index = None
+        self.text_index = None
+        self.field_indexes = {}   # 'type', 'dest' or 'uid' -> PostingIndex
+        self.account_indexes = {} # slot -> array of positions with a non-zero delta
+        self.balance_index = None
+
+    def reset(self):
+        """ Forget all the indexes, which will be rebuilt when next needed """
+        self.date_index = None
+        self.text_index = None
+        self.field_indexes = {}
+        self.account_indexes = {}
+        self.balance_index = None
+
+    def edit(self, position, record):
+        """ Update the indexes after the record at position was changed in place """
+        balance_index = self.balance_index
+        self.reset()
+        # Only the balance index is worth updating rather than building again
+        if balance_index is not None and balance_index.edit(position, record):
+            self.balance_index = balance_index
+
+    def append(self, record):
+        """ Update the indexes after a record was added to the end of the database """
+        row = len(self.database.records) - 1
+        if self.date_index is not None:
+            self.date_index.append(row, record.date.toordinal())
+        if self.text_index is not None:
+            self.text_index.append(row, record.desc, record.dest)
+        for name, posting_index in self.field_indexes.iteritems():
+            posting_index.append(row, getattr(record, name))
+        amounts = record.amounts
+        for slot, rows in self.account_indexes.iteritems():
+            if slot < len(amounts) and amounts[slot] != 0.0:
+                rows.append(row)
+        if self.balance_index is not None and not self.balance_index.append(row, record):
+            self.balance_index = None
+
+    def built(self, name):
+        """ Return whether the PostingIndex of a field already exists """
+        return name in self.field_indexes
+
+    def field(self, name):
+        """ The PostingIndex of 'type', 'dest' or 'uid' """
+        if name not in self.field_indexes:
+            self.field_indexes[name] = PostingIndex(enumerate(field(self.database.records, name)))
+        return self.field_indexes[name]
+
+    def has_account(self, slot):
+        """ Return whether the records with a non-zero delta in a slot are indexed """
+        return slot in self.account_indexes
+
+    def account(self, slot):
+        """ The positions of records with a non-zero delta in the given slot """
+        if slot not in self.account_indexes:
+            self.account_indexes[slot] = nonzero(self.database.records, slot)
+        return self.account_indexes[slot]
+
+    @property
+    def dates(self):
+        """ The DateIndex of the records """
+        if self.date_index is None:
+            self.date_index = DateIndex(self.database.records)
+        return self.date_index
+
+    @property
+    def text(self):
+        """ The TextIndex of the records """
+        if self.text_index is None:
+            self.text_index = TextIndex(self.database.records)
+        return self.text_index
+
+    @property
+    def balances(self):
+        """ The BalanceIndex of the records """
+        if self.balance_index is None:
+            self.balance_index = BalanceIndex(self.database.records, self.dates,
+                                              len(self.database.context.accounts))
+        return self.balance_index
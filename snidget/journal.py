@@ -0,0 +1,96 @@
+""" Defines Journal class, an append-only log of changes to the database file."""
+
+from __future__ import print_function
+import os
+
+# Rather than rewriting the whole database file every time a single record is
+# added, edited or deleted, the change can be appended to a journal kept beside
+# the database file. Replaying the journal over the database file when it is
+# read gives back the current set of records. Once the journal grows long
+# enough, the database is rewritten in full and the journal is discarded.
+
+# Each line of the journal is an action and its argument separated by a |
+#   add|<encoded record>     append a new record
+#   edit|<encoded record>    replace the record with the same UID
+#   delete|<uid>             remove every record with this UID
+ADD = "add"
+EDIT = "edit"
+DELETE = "delete"
+
+
+class Journal(object):
+    """ Journal class, holding changes not yet folded into the database file."""
+    def __init__(self, filename):
+        """ Create a journal stored in the given file """
+        self.filename = filename
+        self.pending = [] # entries not yet written to the file
+        self.length = 0   # number of entries already in the file
+        self.end = None   # where the entries end, if a torn line follows them
+
+    def entries(self):
+        """ Return the list of (action, argument) tuples stored in the file """
+        entries = []
+        try:
+            journal_file = open(self.filename, 'r')
+        except IOError:
+            # No journal means there is nothing to replay
+            return entries
+        offset = 0
+        for line in journal_file:
+            start = offset
+            offset += len(line)
+            if not line.endswith("\n"):
+                # Only the last line can lack a newline, if writing it was cut short
+                print("Error reading journal: last line is incomplete and will be dropped.")
+                self.end = start
+                break
+            line = line.rstrip("\n")
+            if line == "":
+                continue
+            if "|" not in line:
+                print("Error reading journal: line '%s' ignored." % line)
+                continue
+            action, argument = line.split("|", 1)
+            entries.append((action, argument))
+        journal_file.close()
+        self.length = len(entries)
+        return entries
+
+    def add(self, record):
+        """ Note that a new record was added """
+        self.pending.append((ADD, record.encode()))
+
+    def edit(self, record):
+        """ Note that an existing record was changed """
+        self.pending.append((EDIT, record.encode()))
+
+    def delete(self, uid):
+        """ Note that the record with the given uid was deleted """
+        self.pending.append((DELETE, uid))
+
+    def size(self):
+        """ Return the number of entries, including ones not yet written """
+        return self.length + len(self.pending)
+
+    def flush(self):
+        """ Append the pending entries to the journal file """
+        if not self.pending:
+            return
+        journal_file = open(self.filename, 'a')
+        if self.end is not None:
+            # Cut off the torn line, so the new entries don't run on from it
+            journal_file.truncate(self.end)
+            self.end = None
+        for action, argument in self.pending:
+            journal_file.write("%s|%s\n" % (action, argument))
+        journal_file.close()
+        self.length += len(self.pending)
+        self.pending = []
+
+    def clear(self):
+        """ Forget all entries, once they have been folded into the database file """
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.length = 0
+        self.end = None
+        self.pending = []
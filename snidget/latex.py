@@ -48,7 +48,7 @@ def output(database, settings):
     print("    \\textbf{Type} & \\textbf{Total} \\\\")
     print("    \\hline")
     for expense_type in database.balances_by_type():
-        print("       %-14s & %10s \\\\" % expense_type)
+        print("       %-14s & %10.2f \\\\" % expense_type)
     print("    \\hline")
     print("  \\end{tabular}")
 
@@ -63,7 +63,7 @@ def output(database, settings):
         for dest in database.balances_by_recipient():
             name = dest[0].replace("&", "\&")
             value = dest[1]
-            print("         %-30s & %10s \\\\" % (name, value))
+            print("         %-30s & %10.2f \\\\" % (name, value))
         print("    \\hline")
         print("  \\end{tabular}")
 
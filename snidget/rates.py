@@ -0,0 +1,87 @@
+""" Exchange rates of foreign accounts on any date, from the rates on record."""
+
+from array import array
+from bisect import bisect_right
+
+# The value of a record is in the default currency, converting each foreign
+# delta with the exchange rate in effect on the date of the record. Settings
+# keep the rates saved on various dates (historicalRates) as well as the current
+# ones, which are taken to be in effect from today. A RateHistory puts these in
+# order of date once, so the rates on any date are found by bisection. For a
+# list of accounts, a Conversion then holds the rate of every account for each
+# stretch of dates with the same rates, so working out the values of many
+# records needs no lookups in the settings. When the rates have never changed,
+# as with most databases, there is a single stretch and no bisection at all.
+
+
+class Conversion(object):
+    """ Conversion class, the exchange rate of each account for every stretch of dates """
+    def __init__(self, days, vectors):
+        """ Create a conversion from the first day of each stretch and its rates """
+        self.days = days       # ordinal of the first day of each stretch
+        self.vectors = vectors # list of the rate of each account, for each stretch
+        self.constant = len(vectors) == 1
+
+    def position(self, day):
+        """ Return the stretch containing a day, given as an ordinal """
+        # Days before the first known rates use the earliest ones
+        return max(bisect_right(self.days, day) - 1, 0)
+
+    def at(self, day):
+        """ Return the list of the rate of each account on a day """
+        if self.constant:
+            return self.vectors[0]
+        return self.vectors[self.position(day)]
+
+    def breaks(self):
+        """ Return the days on which the rates change """
+        return self.days[1:]
+
+    def without(self, accounts, excluded):
+        """ Return the same conversion of a list of accounts, but with no value for the excluded ones """
+        vectors = [[0.0 if acc in excluded else rate for acc, rate in zip(accounts, vector)]
+                   for vector in self.vectors]
+        return Conversion(self.days, vectors)
+
+
+class RateHistory(object):
+    """ RateHistory class, the exchange rate of each currency on any date """
+    def __init__(self, current, historical, foreign, today):
+        """ Put the historical and current rates in order of date """
+        # Rates for currencies added after a date are unknown then, so use the current ones
+        tables = {}
+        for when, rates in historical.iteritems():
+            table = dict(current)
+            table.update(rates)
+            tables[when.toordinal()] = table
+        tables[today.toordinal()] = dict(current)
+
+        self.foreign = dict(foreign) # account -> currency
+        self.days = array('l')
+        self.tables = [] # currency -> rate, for each day in days
+        for day in sorted(tables):
+            if not self.tables or tables[day] != self.tables[-1]:
+                self.days.append(day)
+                self.tables.append(tables[day])
+        self.conversions = {} # tuple of accounts -> Conversion
+
+    def rate(self, currency, when):
+        """ Return the exchange rate of a currency on a date """
+        position = max(bisect_right(self.days, when.toordinal()) - 1, 0)
+        return self.tables[position][currency]
+
+    def conversion(self, accounts):
+        """ Return the Conversion of a list of accounts """
+        key = tuple(accounts)
+        if key not in self.conversions:
+            foreign = self.foreign
+            days = array('l')
+            vectors = []
+            for day, table in zip(self.days, self.tables):
+                vector = [table[foreign[acc]] if acc in foreign else 1.0 for acc in accounts]
+                # Changes in currencies none of the accounts use make no difference
+                if not vectors or vector != vectors[-1]:
+                    days.append(day)
+                    vectors.append(vector)
+            self.conversions[key] = Conversion(days, vectors)
+        return self.conversions[key]
@@ -0,0 +1,70 @@
+""" Formats records as the lines of a table, resolving the columns once per table."""
+
+# Printing a table of records used to ask the settings which accounts exist and
+# are deleted, and the columns filter whether each account may be shown, for
+# every cell of every row, building the table up as one string. Columns works
+# out once which accounts are shown, and a RowFormat turns that into a single
+# format string, so each row takes one % operation. The database writes the
+# lines to a stream as they are made, so printing every record takes no more
+# memory than printing a few.
+
+
+class Columns(object):
+    """ Columns class, the accounts shown when printing the records of a database """
+    def __init__(self, database):
+        """ Work out which accounts the settings and the columns filter allow """
+        settings = database.settings
+        deleted_names = settings.deleted_account_names()
+        deleted_keys = settings.deleted_account_keys()
+        # Headings are checked by name and cells by key, just as they always were
+        self.names = [name for name in settings.accounts().itervalues()
+                      if name not in deleted_names and database.is_printable(name)]
+        self.keys = [acc for acc in settings.accounts()
+                     if acc not in deleted_keys and database.is_printable(acc)]
+        self.slots = [database.context.slot(acc) for acc in self.keys]
+        self.allowed = set(self.keys)
+
+
+class RowFormat(object):
+    """ RowFormat class, writing a record as one line of a table """
+    def __init__(self, columns, widths, total_value, print_id=True, print_balances=False):
+        """ Make the format of a line, given the widths of the date, type, location and description """
+        self.slots = columns.slots
+        self.total_value = total_value
+        self.print_id = print_id
+        self.print_balances = print_balances and not total_value
+        parts = ["%%-%ds  %%-%ds  %%-%ds  %%-%ds" % widths]
+        cell = "%9.2f "
+        if total_value:
+            parts.append(cell)
+        else:
+            for slot in self.slots:
+                parts.append(cell)
+                if self.print_balances:
+                    parts.append("%s ")
+        if print_id:
+            parts.append("%8s")
+        parts.append("  %6s")
+        self.format = "".join(parts)
+
+    def line(self, record):
+        """ Return the line of a record, without a newline """
+        fields = [record.date, record.type, record.dest, record.desc]
+        if self.total_value:
+            fields.append(record.value())
+        else:
+            amounts = record.amounts
+            balances = record.balances if self.print_balances else None
+            for slot in self.slots:
+                delta = amounts[slot] if slot < len(amounts) else 0.0
+                fields.append(delta or 0.0)
+                if self.print_balances:
+                    # Running balances are only shown where the account changed
+                    if delta and balances is not None and slot < len(balances):
+                        fields.append("%9.2f" % balances[slot])
+                    else:
+                        fields.append("        ")
+        if self.print_id:
+            fields.append(record.id)
+        fields.append(record.uid)
+        return self.format % tuple(fields)
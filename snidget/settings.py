@@ -19,6 +19,7 @@ from datetime import date, timedelta
 import sys
 import os
 import pickle
+from snidget import rates
 
 
 def get_open_exchange_rates():
@@ -45,6 +46,13 @@ class Settings(object):
 
     updated_rates = False
 
+    # Exchange rates in order of date, see rate_history
+    rate_history_cache = None
+
+    # Goes up whenever exchange rates or foreign accounts change, so anything
+    # worked out from them (like the values of records) knows to start again
+    rates_version = 0
+
     # This is the default set of options
     # These will be overwritten if settings.pkl exists
     options = {
@@ -55,6 +63,11 @@ class Settings(object):
         'NPREDICT': 6,          # Number of predictions to suggest
         'DOPREDICTDEST': True,  # Whether to predict the destination or use the places array below
         'NOTCHAR': '#',         # Character used to negate strings
+        'JOURNAL': False,       # Whether to append changes to a journal instead of rewriting
+        'JOURNALMAX': 100,      # Number of journal entries before the database is rewritten
+        'ENGINE': "list",       # How records are stored in memory, "list" or "table"
+        'TEXTINDEX': False,     # Whether to index descriptions and locations for string searches
+        'CUBE': True,           # Whether to keep totals by day, month and year beside the database
 
         # Only used if prediction of places is turned off
         # Different place options for different types?
@@ -165,7 +178,7 @@ class Settings(object):
                 do_save = True
 
             if not self.options['historicalRates']:
-                self.options['historicalRates'][date(1970, 01, 01)] = self.options['exchangeRates']
+                self.options['historicalRates'][date(1970, 01, 01)] = dict(self.options['exchangeRates'])
 
             # Settings were updated so we must save
             if do_save:
@@ -273,6 +286,31 @@ class Settings(object):
                 'desc': 'Set the character used to negate strings and types to x.',
                 'parser': self._parse_not,
             },
+            'journal': {
+                'args': 'boolean',
+                'desc': 'Append changes to a journal beside the database instead of rewriting it.',
+                'parser': self._parse_journal,
+            },
+            'journalmax': {
+                'args': 'integer',
+                'desc': 'The number of journal entries kept before the database is rewritten.',
+                'parser': self._parse_journalmax,
+            },
+            'engine': {
+                'args': 'list|table',
+                'desc': 'Keep records as a list of objects, or in a compact column-wise table.',
+                'parser': self._parse_engine,
+            },
+            'textindex': {
+                'args': 'boolean',
+                'desc': 'Index descriptions and locations, for faster repeated string searches.',
+                'parser': self._parse_textindex,
+            },
+            'cube': {
+                'args': 'boolean',
+                'desc': 'Keep totals by day, month and year, for faster reports over long ranges.',
+                'parser': self._parse_cube,
+            },
             'addplace': {
                 'args': 'name',
                 'desc': 'Add a suggested place name.',
@@ -414,6 +452,52 @@ class Settings(object):
         return False
 
 
+    def _parse_journal(self, arg):
+        old_journal = self.journal()
+        if arg == "True" or arg == "true":
+            self.set_journal(True)
+        else:
+            self.set_journal(False)
+        print("Changed journal from '%s' to '%s'" % (old_journal, self.journal()))
+        return True
+
+
+    def _parse_journalmax(self, arg):
+        old_journal_limit = self.journal_limit()
+        self.set_journal_limit(arg)
+        print("Changed journalmax from '%s' to '%s'" % (old_journal_limit, self.journal_limit()))
+        return True
+
+
+    def _parse_engine(self, arg):
+        old_engine = self.engine()
+        if self.set_engine(arg):
+            print("Changed engine from '%s' to '%s'" % (old_engine, self.engine()))
+            return True
+        print("Engine must be 'list' or 'table'")
+        return False
+
+
+    def _parse_textindex(self, arg):
+        old_text_index = self.text_index()
+        if arg == "True" or arg == "true":
+            self.set_text_index(True)
+        else:
+            self.set_text_index(False)
+        print("Changed textindex from '%s' to '%s'" % (old_text_index, self.text_index()))
+        return True
+
+
+    def _parse_cube(self, arg):
+        old_cube = self.cube()
+        if arg == "True" or arg == "true":
+            self.set_cube(True)
+        else:
+            self.set_cube(False)
+        print("Changed cube from '%s' to '%s'" % (old_cube, self.cube()))
+        return True
+
+
     def _parse_addplace(self, arg):
         if self.add_place(arg):
             print("Added '%s' to places" % arg)
@@ -662,6 +746,31 @@ class Settings(object):
         return self.options.get('MAXPRINT', 25)
 
 
+    def journal(self):
+        """ Return whether changes are appended to a journal """
+        return self.options['JOURNAL']
+
+
+    def journal_limit(self):
+        """ Return the number of journal entries allowed before compacting """
+        return self.options['JOURNALMAX']
+
+
+    def engine(self):
+        """ Return how records are stored in memory """
+        return self.options['ENGINE']
+
+
+    def text_index(self):
+        """ Return whether string searches use an index """
+        return self.options['TEXTINDEX']
+
+
+    def cube(self):
+        """ Return whether reports use the totals by day, month and year """
+        return self.options['CUBE']
+
+
     def allowance(self):
         """ Return the weekly allowance """
         return self.options['ALLOWANCE']
@@ -692,14 +801,37 @@ class Settings(object):
         return bool(acc in self.options['foreignCurrencies'].keys())
 
 
-    def exchange(self, acc):
-        """ Return the exchange rate of an account """
+    def exchange(self, acc, when=None):
+        """ Return the exchange rate of an account, today or in effect on a date """
         if self.is_foreign(acc):
             currency = self.options['foreignCurrencies'][acc]
+            if when is not None:
+                return self.rate_history().rate(currency, when)
             return self.options['exchangeRates'][currency]
         return 1.00
 
 
+    def rate_history(self):
+        """ Return the RateHistory of the historical and current exchange rates """
+        if self.rate_history_cache is None:
+            self.rate_history_cache = rates.RateHistory(self.options['exchangeRates'],
+                                                        self.options['historicalRates'],
+                                                        self.options['foreignCurrencies'],
+                                                        self.TODAY)
+        return self.rate_history_cache
+
+
+    def changed_rates(self):
+        """ Note that exchange rates or foreign accounts changed """
+        self.rates_version += 1
+        self.rate_history_cache = None
+
+
+    def conversion(self, accounts):
+        """ Return the Conversion giving the exchange rate of each of a list of accounts on any date """
+        return self.rate_history().conversion(accounts)
+
+
     def get_exchange_rate(self, currency, data=False):
         """
         Return the conversion to multiply the foreign currency by to get the default currency
@@ -727,7 +859,9 @@ class Settings(object):
     def save_historical_rates(self):
         """ Add the current exchange rates to the historical record """
         if self.updated_rates is True:
-            self.options['historicalRates'][self.TODAY] = self.options['exchangeRates']
+            # Copy the rates, so changing them later doesn't change the record
+            self.options['historicalRates'][self.TODAY] = dict(self.options['exchangeRates'])
+            self.changed_rates()
         else:
             print("Since exchange rates are out of date, they will not be saved as today's rates.")
 
@@ -749,6 +883,38 @@ class Settings(object):
         return True
 
 
+    def set_journal(self, arg):
+        """ Set the journal switch """
+        self.options['JOURNAL'] = bool(arg)
+        return True
+
+
+    def set_journal_limit(self, maxval):
+        """ Set the number of journal entries allowed before compacting """
+        self.options['JOURNALMAX'] = int(maxval)
+        return True
+
+
+    def set_engine(self, engine):
+        """ Set how records are stored in memory """
+        if engine not in ["list", "table"]:
+            return False
+        self.options['ENGINE'] = engine
+        return True
+
+
+    def set_text_index(self, arg):
+        """ Set the text index switch """
+        self.options['TEXTINDEX'] = bool(arg)
+        return True
+
+
+    def set_cube(self, arg):
+        """ Set the cube switch """
+        self.options['CUBE'] = bool(arg)
+        return True
+
+
     def set_allowance(self, value):
         """ Set the weekly allowance """
         self.options['ALLOWANCE'] = float(value)
@@ -851,6 +1017,7 @@ class Settings(object):
 
         # Now save the exchange rate for this currency
         self.options['exchangeRates'][currency] = rate
+        self.changed_rates()
 
         return True
 
@@ -858,6 +1025,7 @@ class Settings(object):
     def set_exchange(self, currency, rate):
         if currency in self.options['exchangeRates'].keys():
             self.options['exchangeRates'][currency] = rate
+            self.changed_rates()
             print("Set exchange rate of %s to %f" % (currency, rate))
             return True
 
@@ -0,0 +1,190 @@
+""" Binary snapshot of the database file, so it need not be parsed on every run."""
+
+import os
+import sys
+import gc
+import marshal
+import hashlib
+from array import array
+from datetime import date
+from itertools import izip, imap, repeat
+from snidget import transaction
+
+# Parsing every line of the database file is by far the slowest part of
+# starting up. After the file is parsed, the records are written beside it in
+# a compact column-wise form, along with the size, modification time and a
+# hash of the end of the file. On the next run, if the file still matches, the
+# columns are read back instead of parsing the text again.
+
+# The deltas of an account are stored as the rows and values of those which
+# aren't zero, or as a whole column when that is smaller, and are always read
+# back as whole columns. A table takes the columns as they are.
+
+# Change this whenever the layout of the snapshot changes
+FORMAT = 3
+
+# Number of bytes at the end of the database file included in the hash
+TAIL = 65536
+
+
+def signature(filename):
+    """ Return a tuple identifying the current contents of a file """
+    stat = os.stat(filename)
+    source = open(filename, 'rb')
+    if stat.st_size > TAIL:
+        source.seek(-TAIL, os.SEEK_END)
+    tail = hashlib.md5(source.read()).hexdigest()
+    source.close()
+    return (stat.st_size, stat.st_mtime, tail)
+
+
+def columns(records, written=False):
+    """ Return the records as a dictionary of columns, rounded as in the file if just written """
+    strings = []
+    codes = {} # string -> index in strings, so each string is stored once
+
+    def intern(string):
+        """ Return the code of a string, adding it to the list if needed """
+        if string not in codes:
+            codes[string] = len(strings)
+            strings.append(string)
+        return codes[string]
+
+    dates = array('l')
+    types = array('i')
+    dests = array('i')
+    descs = array('i')
+    ids = array('i')
+    uids = []
+    deltas = {} # account -> (rows, values), only for non-zero values
+    for row, record in enumerate(records):
+        dates.append(record.date.toordinal())
+        types.append(intern(record.type))
+        dests.append(intern(record.dest))
+        descs.append(intern(record.desc))
+        ids.append(intern(record.id))
+        uids.append(record.uid)
+        for acc, delta in record.deltas.iteritems():
+            if written:
+                # Store exactly what reading the text file back would give
+                delta = float("%.2f" % delta)
+            if delta != 0.0:
+                if acc not in deltas:
+                    deltas[acc] = (array('i'), array('d'))
+                deltas[acc][0].append(row)
+                deltas[acc][1].append(delta)
+
+    return {
+        'strings': strings,
+        'date': dates,
+        'type': types,
+        'dest': dests,
+        'desc': descs,
+        'id': ids,
+        'uid': uids,
+        'deltas': deltas,
+    }
+
+
+def transactions(data, context):
+    """ Return a list of transactions built from a dictionary of columns """
+    strings = data['strings'].__getitem__
+    blank = array('d', [0.0]) * len(data['uid'])
+    deltas = [data['deltas'].get(acc, blank) for acc in context.accounts]
+    # Many records share a date, and a date can be shared as it can't be changed
+    dates = dict((day, date.fromordinal(day)) for day in set(data['date'])).__getitem__
+    # With no accounts at all there are still records, each with no deltas
+    amounts = izip(*deltas) if deltas else repeat(())
+
+    records = []
+    append = records.append
+    # None of these objects can form cycles, so don't let the garbage collector
+    # repeatedly scan them while hundreds of thousands are being created
+    gc.disable()
+    try:
+        for fields in izip(imap(dates, data['date']), imap(strings, data['type']),
+                           imap(strings, data['dest']), imap(strings, data['desc']),
+                           imap(array, repeat('d'), amounts),
+                           imap(strings, data['id']), data['uid']):
+            append(transaction.from_fields(context, *fields))
+    finally:
+        gc.enable()
+    return records
+
+
+class Snapshot(object):
+    """ Snapshot class, reading and writing the cached form of a database file."""
+    def __init__(self, filename, source):
+        """ Create a snapshot stored in filename, caching the file source """
+        self.filename = filename
+        self.source = source
+
+    def load(self, accounts):
+        """ Return the dictionary of columns, or None if the snapshot is out of date """
+        try:
+            snapshot_file = open(self.filename, 'rb')
+            stored = marshal.load(snapshot_file)
+            snapshot_file.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+        if (not isinstance(stored, dict)
+                or stored.get('format') != FORMAT
+                or stored.get('byteorder') != sys.byteorder
+                or stored.get('signature') != signature(self.source)):
+            return None
+
+        # Deltas in accounts the settings didn't have were left out while parsing,
+        # so parse again if the accounts have changed since
+        if stored.get('accounts') != sorted(accounts):
+            return None
+
+        data = {
+            'strings': stored['strings'],
+            'uid': stored['uid'].split('|') if stored['uid'] else [],
+            'deltas': {},
+        }
+        data['date'] = array('l', stored['date'])
+        for column in ['type', 'dest', 'desc', 'id']:
+            data[column] = array('i', stored[column])
+        for acc, values in stored['dense'].iteritems():
+            data['deltas'][acc] = array('d', values)
+        for acc, (rows, values) in stored['deltas'].iteritems():
+            column = array('d', [0.0]) * len(data['uid'])
+            for row, value in izip(array('i', rows), array('d', values)):
+                column[row] = value
+            data['deltas'][acc] = column
+        return data
+
+    def save(self, records, accounts, written=False):
+        """ Write the snapshot of the records, which must match the source file """
+        # written is True when the records were just written to the file, rather than read from it
+        data = columns(records, written)
+        stored = {
+            'format': FORMAT,
+            'byteorder': sys.byteorder,
+            'signature': signature(self.source),
+            'accounts': sorted(accounts),
+            'strings': data['strings'],
+            # UIDs cannot contain |, since it separates fields in the database file
+            'uid': '|'.join(data['uid']),
+            'deltas': {},
+            'dense': {},
+        }
+        for column in ['date', 'type', 'dest', 'desc', 'id']:
+            stored[column] = data[column].tostring()
+        for acc, (rows, values) in data['deltas'].iteritems():
+            if len(rows) * (rows.itemsize + values.itemsize) > len(data['uid']) * values.itemsize:
+                column = array('d', [0.0]) * len(data['uid'])
+                for row, value in izip(rows, values):
+                    column[row] = value
+                stored['dense'][acc] = column.tostring()
+            else:
+                stored['deltas'][acc] = (rows.tostring(), values.tostring())
+        try:
+            snapshot_file = open(self.filename, 'wb')
+            marshal.dump(stored, snapshot_file)
+            snapshot_file.close()
+        except IOError:
+            # The snapshot is only a cache, so failing to write it is not fatal
+            pass
@@ -0,0 +1,372 @@
+""" Defines RecordTable class, which stores transactions column by column."""
+
+from array import array
+from datetime import date
+from itertools import compress, imap, islice, repeat
+from operator import add, mul
+from snidget.transaction import Transaction, sort_key
+
+# A list of Transaction objects costs a few hundred bytes per record, most of it
+# in the two dictionaries and the instance dictionary of every record. The
+# RecordTable keeps each field in its own array instead: dates as ordinals,
+# strings as codes into a single list of unique strings, and one column of
+# deltas per account, in the slots given by the context of the database. It
+# behaves like the list of records the rest of snidget expects, handing out Row
+# objects which read and write a single row.
+#
+# Row objects only know their position in the table, so they should not be kept
+# around while records are being added, deleted, or sorted.
+
+
+class Row(Transaction):
+    """ A transaction which is a view of one row in a RecordTable """
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        """ Create a view of the given row of the table """
+        self.table = table
+        self.row = row
+
+    @property
+    def context(self):
+        """ The context shared by all records in the database """
+        return self.table.context
+
+    @property
+    def date(self):
+        """ Transaction date """
+        return date.fromordinal(self.table.dates[self.row])
+
+    @date.setter
+    def date(self, value):
+        self.table.dates[self.row] = value.toordinal()
+        # The exchange rates, and so the value, depend on the date
+        self.table.changed(self.row)
+
+    @property
+    def type(self):
+        """ Type """
+        return self.table.strings[self.table.types[self.row]]
+
+    @type.setter
+    def type(self, value):
+        self.table.types[self.row] = self.table.code(value)
+
+    @property
+    def dest(self):
+        """ Destination/Location """
+        return self.table.strings[self.table.dests[self.row]]
+
+    @dest.setter
+    def dest(self, value):
+        self.table.dests[self.row] = self.table.code(value)
+
+    @property
+    def desc(self):
+        """ Description """
+        return self.table.strings[self.table.descs[self.row]]
+
+    @desc.setter
+    def desc(self, value):
+        self.table.descs[self.row] = self.table.code(value)
+
+    @property
+    def id(self):
+        """ User specified ID """
+        return self.table.strings[self.table.ids[self.row]]
+
+    @id.setter
+    def id(self, value):
+        self.table.ids[self.row] = self.table.code(value)
+
+    @property
+    def uid(self):
+        """ Unique ID """
+        return self.table.uids[self.row]
+
+    @uid.setter
+    def uid(self, value):
+        self.table.uids[self.row] = value
+
+    @property
+    def visible(self):
+        """ Whether the record passes the current filters """
+        return bool(self.table.visibles[self.row])
+
+    @visible.setter
+    def visible(self, value):
+        self.table.visibles[self.row] = bool(value)
+
+    @property
+    def amounts(self):
+        """ The delta of each account, by slot """
+        return tuple(column[self.row] for column in self.table.deltas)
+
+    @property
+    def balances(self):
+        """ The running balance of each account, by slot """
+        return [self.table.running(slot)[self.row] for slot in xrange(len(self.table.deltas))]
+
+    def set_delta(self, slot, delta):
+        """ Set the change in balance of the account in the given slot """
+        self.table.columns()
+        self.table.deltas[slot][self.row] = delta
+        self.table.changed(self.row)
+
+    def value(self):
+        """ Return total value of transaction, at the exchange rates on its date """
+        return self.table.values()[self.row]
+
+    def set_running_balance(self, account, balance):
+        """ Running balances are always calculated from the deltas in the table """
+        return
+
+
+class RecordTable(object):
+    """ RecordTable class, a list of records stored as columns """
+    def __init__(self, database, settings):
+        """ Create an empty table of records """
+        self.database = database
+        self.settings = settings
+        self.strings = [] # every distinct type, dest, desc and id
+        self.codes = {}   # string -> index in self.strings
+        self.dates = array('l')
+        self.types = array('i')
+        self.dests = array('i')
+        self.descs = array('i')
+        self.ids = array('i')
+        self.uids = []
+        self.visibles = bytearray()
+        self.deltas = []   # one array per account slot, with one value per record
+        self.balances = {} # slot -> array of running balances, made when needed
+        self.worths = array('d') # value of the first rows, made when needed
+        self.worths_version = None # rates version the values were worked out with
+        self.context = database.context
+        self.columns()
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __iter__(self):
+        # Records may be removed while iterating, so check the length each time
+        row = 0
+        while row < len(self.uids):
+            yield Row(self, row)
+            row += 1
+
+    def __reversed__(self):
+        for row in xrange(len(self.uids) - 1, -1, -1):
+            yield Row(self, row)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Row(self, row) for row in xrange(*index.indices(len(self.uids)))]
+        if index < 0:
+            index += len(self.uids)
+        if index < 0 or index >= len(self.uids):
+            raise IndexError("record index out of range")
+        return Row(self, index)
+
+    def __setitem__(self, index, record):
+        row = self[index].row
+        self.dates[row] = record.date.toordinal()
+        self.types[row] = self.code(record.type)
+        self.dests[row] = self.code(record.dest)
+        self.descs[row] = self.code(record.desc)
+        self.ids[row] = self.code(record.id)
+        self.uids[row] = record.uid
+        self.visibles[row] = bool(record.visible)
+        for column in self.deltas:
+            column[row] = 0.0
+        for acc, delta in record.deltas.iteritems():
+            self.deltas[self.slot(acc)][row] = delta
+        self.changed(row)
+
+    def __delitem__(self, index):
+        row = self[index].row
+        for column in [self.dates, self.types, self.dests, self.descs, self.ids,
+                       self.uids, self.visibles] + self.deltas:
+            del column[row]
+        self.changed(row)
+
+    def delete_rows(self, rows):
+        """ Remove the rows at any of the given positions, all in one pass """
+        keep = bytearray([True]) * len(self.uids)
+        for row in rows:
+            keep[row] = False
+        self.dates = array('l', compress(self.dates, keep))
+        self.types = array('i', compress(self.types, keep))
+        self.dests = array('i', compress(self.dests, keep))
+        self.descs = array('i', compress(self.descs, keep))
+        self.ids = array('i', compress(self.ids, keep))
+        self.uids = list(compress(self.uids, keep))
+        self.visibles = bytearray(compress(self.visibles, keep))
+        self.deltas = [array('d', compress(column, keep)) for column in self.deltas]
+        self.changed(min(rows) if rows else len(self.uids))
+
+    def code(self, string):
+        """ Return the code for a string, adding it to the table if needed """
+        if string not in self.codes:
+            self.codes[string] = len(self.strings)
+            self.strings.append(string)
+        return self.codes[string]
+
+    def slot(self, acc):
+        """ Return the column of deltas for an account, adding it if needed """
+        slot = self.context.slot(acc)
+        self.columns()
+        return slot
+
+    def columns(self):
+        """ Make sure there is a column of deltas for every slot in the context """
+        while len(self.deltas) < len(self.context.accounts):
+            self.deltas.append(array('d', [0.0]) * len(self.uids))
+
+    def changed(self, row=0):
+        """ Forget anything calculated from the given row onward """
+        for balances in self.balances.itervalues():
+            del balances[row:]
+        del self.worths[row:]
+
+    def insert(self, index, record):
+        """ Add a copy of a transaction before the given position, like list.insert """
+        row = max(0, min(index + len(self.uids) if index < 0 else index, len(self.uids)))
+        self.dates.insert(row, record.date.toordinal())
+        self.types.insert(row, self.code(record.type))
+        self.dests.insert(row, self.code(record.dest))
+        self.descs.insert(row, self.code(record.desc))
+        self.ids.insert(row, self.code(record.id))
+        self.uids.insert(row, record.uid)
+        self.visibles.insert(row, bool(record.visible))
+        for column in self.deltas:
+            column.insert(row, 0.0)
+        for acc, delta in record.deltas.iteritems():
+            self.deltas[self.slot(acc)][row] = delta
+        self.changed(row)
+
+    def append(self, record):
+        """ Add a copy of a transaction to the end of the table """
+        self.dates.append(record.date.toordinal())
+        self.types.append(self.code(record.type))
+        self.dests.append(self.code(record.dest))
+        self.descs.append(self.code(record.desc))
+        self.ids.append(self.code(record.id))
+        self.uids.append(record.uid)
+        self.visibles.append(bool(record.visible))
+        for column in self.deltas:
+            column.append(0.0)
+        for acc, delta in record.deltas.iteritems():
+            self.deltas[self.slot(acc)][-1] = delta
+        self.changed(len(self.uids) - 1)
+
+    def remove(self, record):
+        """ Remove a record, like list.remove """
+        if isinstance(record, Row) and record.table is self:
+            del self[record.row]
+            return
+        for row in self:
+            if row == record:
+                del self[row.row]
+                return
+        raise ValueError("record not in table")
+
+    def sort(self, cmp=None, key=None, reverse=False):
+        """ Reorder the rows, like list.sort """
+        if cmp is None and key in (None, sort_key):
+            # Put the rows in the order of transactions, with keys made a column at a time
+            order = sorted(xrange(len(self.uids)), reverse=reverse,
+                           key=self.sort_keys().__getitem__)
+        elif key is None:
+            # Compare the rows as transactions
+            order = sorted(xrange(len(self.uids)), cmp=cmp, reverse=reverse,
+                           key=lambda row: Row(self, row))
+        else:
+            order = sorted(xrange(len(self.uids)), cmp=cmp, reverse=reverse,
+                           key=lambda row: key(Row(self, row)))
+        self.dates = array('l', [self.dates[row] for row in order])
+        self.types = array('i', [self.types[row] for row in order])
+        self.dests = array('i', [self.dests[row] for row in order])
+        self.descs = array('i', [self.descs[row] for row in order])
+        self.ids = array('i', [self.ids[row] for row in order])
+        self.uids = [self.uids[row] for row in order]
+        self.visibles = bytearray([self.visibles[row] for row in order])
+        self.deltas = [array('d', [column[row] for row in order]) for column in self.deltas]
+        self.changed()
+
+    def load(self, data):
+        """ Fill an empty table from a dictionary of columns read from a snapshot """
+        self.strings = list(data['strings'])
+        self.codes = dict((string, code) for code, string in enumerate(self.strings))
+        self.dates = data['date']
+        self.types = data['type']
+        self.dests = data['dest']
+        self.descs = data['desc']
+        self.ids = data['id']
+        self.uids = data['uid']
+        self.visibles = bytearray([True]) * len(self.uids)
+        self.deltas = [array('d', [0.0]) * len(self.uids) for acc in self.context.accounts]
+        for acc, column in data['deltas'].iteritems():
+            self.deltas[self.slot(acc)] = column
+        self.changed()
+
+    #--------------------------------------------------------------------------
+    # Operations on whole columns
+    #--------------------------------------------------------------------------
+
+    def sort_keys(self):
+        """ Return a list with the sort_key of every row """
+        strings = self.strings
+        return zip(self.dates, imap(strings.__getitem__, self.types),
+                   imap(strings.__getitem__, self.dests), imap(strings.__getitem__, self.descs),
+                   self.values(), imap(strings.__getitem__, self.ids), self.uids)
+
+    def running(self, slot):
+        """ Return the running balance of an account after every row """
+        if slot not in self.balances:
+            self.balances[slot] = array('d')
+        balances = self.balances[slot]
+        # Carry on from the last row whose balance is still known
+        if len(balances) < len(self.uids):
+            total = balances[-1] if balances else 0.0
+            for delta in islice(self.deltas[slot], len(balances), None):
+                total += delta
+                balances.append(total)
+        return balances
+
+    def values(self, conversion=None):
+        """ Return an array with the total value of every row, at the exchange rates on its date """
+        if conversion is not None:
+            # Values at some other rates, such as leaving accounts out, are not kept
+            return self.worth(conversion)
+        if self.worths_version != self.settings.rates_version:
+            self.worths = array('d')
+            self.worths_version = self.settings.rates_version
+        # Carry on from the last row whose value is still known
+        start = len(self.worths)
+        if start < len(self.uids):
+            self.worths.extend(self.worth(self.context.conversion(), start))
+        return self.worths
+
+    def worth(self, conversion, start=0):
+        """ Return an array with the value of every row from start on, given a Conversion """
+        if not conversion.constant:
+            positions = array('l', imap(conversion.position, islice(self.dates, start, None)))
+        total = array('d', [0.0]) * (len(self.uids) - start)
+        for slot, column in enumerate(self.deltas):
+            if conversion.constant:
+                rates = repeat(conversion.vectors[0][slot])
+            else:
+                rates = imap([vector[slot] for vector in conversion.vectors].__getitem__,
+                             positions)
+            total = array('d', imap(add, total, imap(mul, islice(column, start, None), rates)))
+        return total
+
+    def sums(self, selectors=None):
+        """ Return a dictionary of the sum of each account over selected rows """
+        totals = {}
+        for acc, column in zip(self.context.accounts, self.deltas):
+            if selectors is None:
+                totals[acc] = sum(column)
+            else:
+                totals[acc] = sum(compress(column, selectors))
+        return totals
@@ -1,9 +1,12 @@
 """ Defines transaction class, containing info on individual transactions"""
 
 from __future__ import print_function
+from array import array
+from collections import MutableMapping
 from datetime import date
 from time import time
 import readline
+from snidget import render
 
 
 def new_uid():
@@ -28,23 +31,162 @@ def new_uid():
     return uid
 
 
+class Context(object):
+    """ Context class, holding what every transaction in a database shares """
+    def __init__(self, database, settings):
+        """ Create the context for transactions belonging to a database """
+        self.database = database
+        self.settings = settings
+        self.accounts = [] # account key of each slot in Transaction.amounts
+        self.slots = {}    # account key -> slot
+        self.conversion_key = None # rates version and number of slots of conversion_cache
+        self.conversion_cache = None
+        # Known accounts get the first slots, in the order the settings list them
+        for acc in settings.account_keys():
+            self.slot(acc)
+
+    def slot(self, acc):
+        """ Return the slot of an account in Transaction.amounts, adding it if needed """
+        if acc not in self.slots:
+            self.slots[acc] = len(self.accounts)
+            self.accounts.append(acc)
+        return self.slots[acc]
+
+    def conversion(self):
+        """ Return the Conversion giving the exchange rate of each slot on any date """
+        # Accounts only ever get new slots at the end, so their number is enough to tell
+        key = (self.settings.rates_version, len(self.accounts))
+        if self.conversion_key != key:
+            self.conversion_cache = self.settings.conversion(self.accounts)
+            self.conversion_key = key
+        return self.conversion_cache
+
+
+class Deltas(MutableMapping):
+    """ The deltas of a transaction, behaving like a dictionary of account -> delta """
+    # Accounts with a delta of zero are treated as not being in the dictionary,
+    # just as they are left out when the record is written to the file.
+
+    def __init__(self, record):
+        self.record = record
+
+    def __getitem__(self, acc):
+        slot = self.record.context.slots.get(acc)
+        amounts = self.record.amounts
+        if slot is None or slot >= len(amounts) or amounts[slot] == 0.0:
+            raise KeyError(acc)
+        return amounts[slot]
+
+    def __setitem__(self, acc, value):
+        self.record.set_delta(self.record.context.slot(acc), value)
+
+    def __delitem__(self, acc):
+        self[acc] # raise KeyError if not there
+        self.record.set_delta(self.record.context.slots[acc], 0.0)
+
+    def __iter__(self):
+        accounts = self.record.context.accounts
+        for slot, delta in enumerate(self.record.amounts):
+            if delta != 0.0:
+                yield accounts[slot]
+
+    def __len__(self):
+        return sum(1 for delta in self.record.amounts if delta != 0.0)
+
+    def has_key(self, acc):
+        """ Same as acc in deltas """
+        return acc in self
+
+
+class Balances(Deltas):
+    """ The running balances of a transaction, for the accounts with deltas """
+
+    def __getitem__(self, acc):
+        super(Balances, self).__getitem__(acc) # raise KeyError if no delta
+        balances = self.record.balances
+        slot = self.record.context.slots[acc]
+        if balances is None or slot >= len(balances):
+            raise KeyError(acc)
+        return balances[slot]
+
+    def __setitem__(self, acc, value):
+        self.record.set_running_balance(acc, value)
+
+    def __iter__(self):
+        if self.record.balances is not None:
+            for acc in super(Balances, self).__iter__():
+                yield acc
+
+    def __len__(self):
+        return sum(1 for acc in self)
+
+
+def sort_key(record):
+    """ Return the tuple records are put in order by, the same order as comparing them """
+    return (record.date.toordinal(), record.type, record.dest, record.desc, record.value(),
+            record.id, record.uid)
+
+
+def in_order(first, second):
+    """ Return whether two records are in order, not making their sort keys if it can help it """
+    if first.date != second.date:
+        return first.date < second.date
+    return sort_key(first) <= sort_key(second)
+
+
+class SortKeys(object):
+    """ The sort keys of a list of records, each worked out only when looked at """
+    # Lets bisect find where a record belongs without making every key
+    def __init__(self, records):
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, position):
+        return sort_key(self.records[position])
+
+
+def from_fields(context, record_date, record_type, dest, desc, amounts, record_id, uid):
+    """ Create a transaction from values which have already been parsed """
+    record = Transaction.__new__(Transaction)
+    record.context = context
+    record.date = record_date
+    record.type = record_type
+    record.dest = dest
+    record.desc = desc
+    record.amounts = amounts
+    record.id = record_id
+    record.uid = uid
+    record.balances = None
+    record.visible = True
+    record.worth = None
+    return record
+
+
 class Transaction(object):
     """ Transaction class, containing info on individual transactions"""
 
+    # A database can hold hundreds of thousands of transactions, so they don't get
+    # an instance dictionary. Deltas are kept in an array with one slot for each
+    # account, in the order given by the context shared by the whole database.
+    __slots__ = ('context', 'date', 'type', 'dest', 'desc', 'id', 'uid', 'visible',
+                 'amounts', 'balances', 'worth')
+
     def __init__(self, database, settings, record_string=""):
         """ Parse a string into a new transaction, or create an empty one """
-        self.database = database
-        self.settings = settings
+        self.context = database.context
+        self.amounts = array('d', [0.0]) * len(self.context.accounts)
+        self.balances = None # running balances, set by the database when needed
+        self.worth = None    # (rates version, date, value) when value was last worked out
+        self.visible = True
         if record_string == "":
             self.date = self.settings.TODAY
             self.type = ""
             self.dest = ""
             self.desc = ""
-            self.deltas = {}
-            self.resulting_balance = {}
             self.id = ""
             self.uid = new_uid()
-            self.visible = True
 
         else:
             # Split the string, with trailing whitespace (including \n) removed
@@ -58,21 +200,24 @@ class Transaction(object):
             self.dest = record_list[2] # Destination/Location
             self.desc = record_list[3] # Description
 
-            self.deltas = {}
-
             # split string of deltas into individual An=0.0 strings
             deltastrings = record_list[4].split(',')
+            accounts = settings.accounts()
+            slots = self.context.slots
             for string in deltastrings:
                 arg = string.split('=')
 
                 if len(arg) == 2:
-                    if arg[0] in self.settings.accounts():
+                    if arg[0] in accounts:
                         acc = arg[0]
                     else:
                         #! Should ask for a new account name and add it
                         print("Error reading database: Account ID not recognized.")
                     delta = arg[1]
-                    self.deltas[acc] = float(delta)
+                    if acc in slots and slots[acc] < len(self.amounts):
+                        self.amounts[slots[acc]] = float(delta)
+                    else:
+                        self.set_delta(self.context.slot(acc), float(delta))
 
             self.id = record_list[5] # ID
             self.uid = record_list[6]  # Unique ID
@@ -82,8 +227,37 @@ class Transaction(object):
             while len(self.uid) < 6:
                 self.uid = "0%s" % self.uid
 
-            self.resulting_balance = {}
-            self.visible = True
+
+    @property
+    def database(self):
+        """ The database this transaction belongs to """
+        return self.context.database
+
+
+    @property
+    def settings(self):
+        """ The user settings """
+        return self.context.settings
+
+
+    @property
+    def deltas(self):
+        """ Dictionary of account -> change in balance """
+        return Deltas(self)
+
+
+    @property
+    def resulting_balance(self):
+        """ Dictionary of account -> balance after this transaction """
+        return Balances(self)
+
+
+    def set_delta(self, slot, delta):
+        """ Set the change in balance of the account in the given slot """
+        if slot >= len(self.amounts):
+            self.amounts.extend([0.0] * (slot + 1 - len(self.amounts)))
+        self.amounts[slot] = delta
+        self.worth = None
 
 
     def str_value(self, print_id=True, w_date=10, w_type=9, w_dest=24, w_desc=34):
@@ -98,54 +272,13 @@ class Transaction(object):
 
 
     def __str__(self, total_value=None, print_id=True, w_date=10, w_type=9, w_dest=24, w_desc=34,
-                print_balances=False, csv=False):
+                print_balances=False):
         """ Write transaction as a string to be printed """
-        # Define the format string using the received inputs for column widths
-
         if total_value is None:
             total_value = self.settings.total_values()
-
-        if csv:
-             # quotes around destination and description, which can have commas themselves
-            lineformat = '%s,%s,"%s","%s"'
-        else:
-            lineformat = "%%-%ds  %%-%ds  %%-%ds  %%-%ds" % (w_date, w_type, w_dest, w_desc)
-        output = lineformat % (self.date, self.type, self.dest, self.desc)
-        if total_value:
-            if csv:
-                output += ",%f" % self.value()
-            else:
-                output += "%9.2f " % self.value()
-        else:
-            for acc in self.settings.accounts():
-                if (acc not in self.settings.deleted_account_keys()
-                        and self.database.is_printable(acc)):
-                    if acc in self.deltas.keys():
-                        this_value = self.deltas[acc]
-                    else:
-                        this_value = float("0.0")
-                    if csv:
-                        output += ",%f" % this_value
-                    else:
-                        output += "%9.2f " % this_value
-                    if print_balances:
-                        if csv:
-                            output += ","
-                        if acc in self.resulting_balance.keys():
-                            output += "%9.2f" % self.resulting_balance[acc]
-                        else:
-                            output += "        "
-                        if not csv:
-                            output += " "
-        if print_id:
-            if csv:
-                output += ","
-            output += "%8s" % self.id
-        if csv:
-            output += ",%s" % self.uid
-        else:
-            output += "  %6s" % self.uid
-        return output
+        row_format = render.RowFormat(render.Columns(self.database), (w_date, w_type, w_dest, w_desc),
+                                      total_value, print_id, print_balances)
+        return row_format.line(self)
 
 
     def __cmp__(self, other):
@@ -153,19 +286,7 @@ class Transaction(object):
         # Must check all attributes, since this tells us when transactions are equal
         #! Possibly if uid==uid, return 0 (to mean they are equal, I think)
         #! Could use to ignore duplicate entries when merging two databases?
-        if self.date != other.date:
-            return cmp(self.date, other.date)
-        elif self.type != other.type:
-            return cmp(self.type, other.type)
-        elif self.dest != other.dest:
-            return cmp(self.dest, other.dest)
-        elif self.desc != other.desc:
-            return cmp(self.desc, other.desc)
-        elif self.value() != other.value():
-            return cmp(self.value(), other.value())
-        elif self.id != other.id:
-            return cmp(self.id, other.id)
-        return cmp(self.uid, other.uid)
+        return cmp(sort_key(self), sort_key(other))
 
 
     def encode(self):
@@ -186,19 +307,35 @@ class Transaction(object):
 
 
     def value(self):
-        """ Return total value of transaction """
+        """ Return total value of transaction, at the exchange rates on its date """
+        # Kept until the deltas, the date, or the exchange rates change
+        settings = self.settings
+        worth = self.worth
+        if worth is not None and worth[0] == settings.rates_version and worth[1] == self.date:
+            return worth[2]
         total = 0.0
-        for acc, value in self.deltas.iteritems():
-            if acc in self.settings.foreign_account_keys():
-                total += value*self.settings.exchange(acc)
-            else:
-                total += value
+        conversion = self.context.conversion()
+        if conversion.constant:
+            rates = conversion.vectors[0]
+        else:
+            rates = conversion.at(self.date.toordinal())
+        for slot, value in enumerate(self.amounts):
+            if value != 0.0:
+                total += value*rates[slot]
+        self.worth = (settings.rates_version, self.date, total)
         return total
 
 
     def set_running_balance(self, account, balance):
         """ Set the resulting balance of the account after this transaction """
-        self.resulting_balance[account] = balance
+        slot = self.context.slots.get(account)
+        if slot is None:
+            slot = self.context.slot(account)
+        if self.balances is None:
+            self.balances = array('d', [0.0]) * len(self.amounts)
+        if slot >= len(self.balances):
+            self.balances.extend([0.0] * (slot + 1 - len(self.balances)))
+        self.balances[slot] = balance
         return
 
 